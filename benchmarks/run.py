@@ -0,0 +1,322 @@
+"""
+Benchmarks the import latency, rebuild latency and packaging time of Nimporter.
+
+Results are written as JSON so that they can be compared across versions:
+
+    $ python benchmarks/run.py --output before.json
+    $ git checkout my-branch
+    $ python benchmarks/run.py --output after.json
+
+Benchmarks that need the Nim compiler are skipped if it is not on the path.
+Everything else runs on synthetic projects generated in a temporary folder.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import *
+from pathlib import Path
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPOSITORY))
+
+import synthetic
+import nimporter
+from nimporter.lib import find_extensions, hash_extension, get_extension_hash
+from nimporter.nimporter import nimport, invalidate_caches
+
+TEST_DATA = REPOSITORY / 'tests' / 'data'
+Result = Dict[str, Any]
+
+
+def measure(function: Callable[[], Any], repeat: int = 5) -> Dict[str, float]:
+    "Runs a function several times and summarizes its duration in seconds."
+    durations = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return dict(
+        min=min(durations),
+        median=statistics.median(durations),
+        max=max(durations),
+    )
+
+
+def has_nim() -> bool:
+    return bool(shutil.which('nim') and shutil.which('nimble'))
+
+
+def run_python(code: str, cwd: Path, env: Dict[str, str]) -> str:
+    "Runs Python code in a new interpreter and returns what it printed."
+    process = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=cwd,
+        env={**os.environ, 'PYTHONPATH': str(REPOSITORY), **env},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    if process.returncode:
+        raise RuntimeError(process.stderr)
+
+    return process.stdout
+
+
+def time_import(name: str, cwd: Path, env: Dict[str, str]) -> float:
+    "Returns how long a new interpreter takes to import an extension."
+    code = (
+        'import time, nimporter\n'
+        'start = time.perf_counter()\n'
+        f'import {name}\n'
+        'print(time.perf_counter() - start)\n'
+    )
+    return float(run_python(code, cwd, env).strip().splitlines()[-1])
+
+
+def copy_test_project(destination: Path) -> Path:
+    shutil.copytree(
+        TEST_DATA,
+        destination,
+        ignore=shutil.ignore_patterns(
+            '__pycache__', 'build', 'dist', '*.egg-info'
+        )
+    )
+    return destination
+
+
+def bench_finder_overhead(workspace: Path, quick: bool) -> Result:
+    "Cost of rejecting imports of Python modules as `sys.path` grows."
+    results = {}
+
+    for entries in (10, 50, 100) if quick else (10, 50, 100, 250, 500):
+        search_path = synthetic.make_search_path(
+            workspace / f'path{entries}', entries
+        )
+        original_path = list(sys.path)
+        sys.path[:] = search_path + original_path
+        loops = 200
+
+        def reject() -> None:
+            for _ in range(loops):
+                nimport('not_a_nim_module', None, library=False)
+                nimport('not_a_nim_module', None, library=True)
+
+        try:
+            invalidate_caches()
+            first = measure(reject, repeat=1)['median']
+            timings = measure(reject)
+        finally:
+            sys.path[:] = original_path
+
+        results[str(entries)] = dict(
+            first_lookup_us=first / loops * 1e6,
+            lookup_us=timings['median'] / loops * 1e6,
+        )
+
+    return results
+
+
+def bench_import_overhead(workspace: Path, quick: bool) -> Result:
+    """
+    Time taken by a new interpreter to import Python modules from a long
+    `sys.path` without Nimporter, with its path hook and with its meta path
+    importers (`NIMPORTER_META_PATH`).
+    """
+    results = {}
+    modes = dict(
+        python=('', {}),
+        path_hook=('import nimporter\n', {}),
+        meta_path=('import nimporter\n', {'NIMPORTER_META_PATH': '1'}),
+    )
+
+    for entries in (10, 100) if quick else (10, 100, 500):
+        search_path = synthetic.make_search_path(
+            workspace / f'path{entries}', entries
+        )
+        path_setup = f'import sys, time\nsys.path[:0] = {search_path!r}\n'
+        code = (
+            'start = time.perf_counter()\n'
+            f'for index in range({entries}):\n'
+            "    __import__(f'module{index}')\n"
+            'print(time.perf_counter() - start)\n'
+        )
+        results[str(entries)] = {}
+
+        for mode, (setup, env) in modes.items():
+            durations = [
+                float(run_python(path_setup + setup + code, workspace, env))
+                for _ in range(3 if quick else 10)
+            ]
+            results[str(entries)][f'{mode}_ms'] = (
+                statistics.median(durations) * 1e3
+            )
+
+    return results
+
+
+def bench_hash_extension(workspace: Path, quick: bool) -> Result:
+    "Cost of hashing a library versus the number of files it contains."
+    results = {}
+
+    for files in (1, 10, 100) if quick else (1, 10, 100, 1000):
+        library = synthetic.make_library(
+            workspace / f'hash{files}', f'lib{files}', files, 4096
+        )
+        synthetic.age(library)
+        get_extension_hash(library)
+
+        results[str(files)] = dict(
+            hash_ms=measure(lambda: hash_extension(library))['median'] * 1e3,
+            unchanged_ms=(
+                measure(lambda: get_extension_hash(library))['median'] * 1e3
+            ),
+        )
+
+    # Libraries vendoring data files, as well as their version control folder
+    library = synthetic.make_library(
+        workspace / 'assets', 'assets', 10, 4096
+    )
+    synthetic.add_assets(library, 10 if quick else 50, 1024 * 1024)
+    synthetic.age(library)
+    results['10_with_assets'] = dict(
+        hash_ms=measure(lambda: hash_extension(library))['median'] * 1e3
+    )
+
+    return results
+
+
+def bench_find_extensions(workspace: Path, quick: bool) -> Result:
+    "Cost of discovering extensions in large project trees."
+    results = {}
+
+    for directories in (1000,) if quick else (1000, 5000):
+        root = workspace / f'tree{directories}'
+        synthetic.make_tree(root, directories)
+
+        results[str(directories)] = dict(
+            extensions=len(find_extensions(root)),
+            find_ms=measure(lambda: find_extensions(root), 3)['median'] * 1e3,
+        )
+
+    return results
+
+
+def bench_compile_and_import(workspace: Path, quick: bool) -> Result:
+    "Cold compile time and warm (cached) import time of the test project."
+    project = copy_test_project(workspace / 'imports')
+    env = {'NIMPORTER_CACHE_DIR': str(workspace / 'import-cache')}
+    results = {}
+
+    meta_path_env = {**env, 'NIMPORTER_META_PATH': '1'}
+
+    for name in ('ext_mod_basic', 'ext_lib_basic'):
+        cold = time_import(name, project, env)
+        warm = [
+            time_import(name, project, env) for _ in range(3 if quick else 10)
+        ]
+        warm_meta_path = [
+            time_import(name, project, meta_path_env)
+            for _ in range(3 if quick else 10)
+        ]
+
+        results[name] = dict(
+            cold_compile_s=cold,
+            warm_import_ms=statistics.median(warm) * 1e3,
+            warm_import_meta_path_ms=statistics.median(warm_meta_path) * 1e3,
+        )
+
+    return results
+
+
+def bench_sdist(workspace: Path, quick: bool) -> Result:
+    "End to end time of generating C for every platform for an sdist."
+    project = copy_test_project(workspace / 'sdist')
+    code = (
+        'import sys, time\n'
+        "sys.argv = ['setup.py', 'sdist']\n"
+        'start = time.perf_counter()\n'
+        'import nimporter\n'
+        'extensions = nimporter.get_nim_extensions(\n'
+        '    [nimporter.WINDOWS, nimporter.MACOS, nimporter.LINUX]\n'
+        ')\n'
+        'print(len(extensions), time.perf_counter() - start)\n'
+    )
+    extensions, duration = run_python(code, project, {}).split()[-2:]
+    return dict(
+        extensions=int(extensions),
+        get_nim_extensions_s=float(duration)
+    )
+
+
+BENCHMARKS: Dict[str, Tuple[Callable[[Path, bool], Result], bool]] = {
+    'finder_overhead': (bench_finder_overhead, False),
+    'import_overhead': (bench_import_overhead, False),
+    'hash_extension': (bench_hash_extension, False),
+    'find_extensions': (bench_find_extensions, False),
+    'compile_and_import': (bench_compile_and_import, True),
+    'sdist': (bench_sdist, True),
+}
+
+
+def main(cli_args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Nimporter benchmarks')
+    parser.add_argument(
+        '-o', '--output', type=Path, default=Path('benchmark-results.json'),
+        help='Where to write the results as JSON'
+    )
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Use smaller synthetic projects and fewer repetitions'
+    )
+    parser.add_argument(
+        'benchmarks', nargs='*', default=[],
+        help=f'Benchmarks to run ({", ".join(BENCHMARKS)}). Defaults to all'
+    )
+    args = parser.parse_args(cli_args)
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'Unknown benchmark: {name}')
+
+    report: Dict[str, Any] = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        nim=nimporter.lib.get_nim_version() if has_nim() else None,
+        time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        results={},
+        skipped={},
+    )
+
+    with tempfile.TemporaryDirectory() as workspace:
+        for name in args.benchmarks or BENCHMARKS:
+            benchmark, needs_nim = BENCHMARKS[name]
+
+            if needs_nim and not has_nim():
+                report['skipped'][name] = 'Nim is not on the path'
+                print(f'Skipping {name}: Nim is not on the path')
+                continue
+
+            print(f'Running {name}')
+            folder = Path(workspace) / name
+            folder.mkdir()
+            report['results'][name] = benchmark(folder, args.quick)
+
+    args.output.write_text(json.dumps(report, indent=4))
+    print(json.dumps(report['results'], indent=4))
+    print('Results written to', args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
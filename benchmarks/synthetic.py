@@ -0,0 +1,148 @@
+"""
+Generates synthetic projects for benchmarking Nimporter.
+
+The generated extensions are valid Nimpy extensions so they can be compiled,
+but their main purpose is to reproduce the shape of large projects: many
+folders, large extension libraries and long `sys.path` lists.
+"""
+
+import os
+import time
+from typing import *
+from pathlib import Path
+
+MODULE_SOURCE: str = '''import nimpy
+
+proc add(a: int, b: int): int {.exportpy.} =
+    return a + b
+'''
+
+
+def make_module(folder: Path, name: str) -> Path:
+    "Writes an extension module named `name` into `folder`."
+    folder.mkdir(parents=True, exist_ok=True)
+    module = folder / f'{name}.nim'
+    module.write_text(MODULE_SOURCE)
+    return module
+
+
+def make_library(
+    folder: Path,
+    name: str,
+    files: int = 1,
+    file_size: int = 1024
+) -> Path:
+    """
+    Writes an extension library named `name` into `folder`.
+
+    Args:
+        folder(Path): where to create the library folder.
+        name(str): the name of the library.
+        files(int): how many Nim files the library contains, including the
+            main module.
+        file_size(int): the size in bytes of each additional Nim file.
+    """
+    library = folder / name
+    library.mkdir(parents=True, exist_ok=True)
+    (library / f'{name}.nim').write_text(MODULE_SOURCE)
+    (library / f'{name}.nim.cfg').write_text('')
+    (library / f'{name}.nimble').write_text(
+        'version = "0.1.0"\nauthor = "benchmark"\ndescription = "benchmark"\n'
+        'license = "MIT"\n\nrequires "nim >= 1.0.0", "nimpy"\n'
+    )
+
+    line = '# ' + 'x' * 77 + '\n'
+
+    for index in range(files - 1):
+        (library / f'helper{index}.nim').write_text(
+            (line * (file_size // len(line) + 1))[:file_size]
+        )
+
+    return library
+
+
+def add_assets(library: Path, files: int, file_size: int) -> None:
+    """
+    Adds data files and a version control folder to a library, which are not
+    part of its build but make it larger to hash if they are included.
+    """
+    for folder in ('data', '.git/objects'):
+        (library / folder).mkdir(parents=True, exist_ok=True)
+
+        for index in range(files):
+            (library / folder / f'asset{index}.bin').write_bytes(
+                os.urandom(file_size)
+            )
+    return
+
+
+def make_tree(
+    root: Path,
+    directories: int,
+    extensions_every: int = 100,
+    fanout: int = 10
+) -> List[Path]:
+    """
+    Creates a folder tree containing Python files and some Nim extensions.
+
+    Args:
+        root(Path): the folder to create the tree in.
+        directories(int): the total number of folders to create.
+        extensions_every(int): place a Nim extension module in every Nth
+            folder and a Nim extension library in every 10 * Nth folder.
+        fanout(int): the number of sub folders of each folder.
+
+    Returns:
+        The created folders.
+    """
+    folders = [root]
+    root.mkdir(parents=True, exist_ok=True)
+    index = 0
+
+    while len(folders) < directories + 1:
+        parent = folders[index]
+        index += 1
+
+        for child in range(fanout):
+            if len(folders) >= directories + 1:
+                break
+
+            folder = parent / f'pkg{child}'
+            folder.mkdir()
+            (folder / '__init__.py').write_text('')
+            folders.append(folder)
+            number = len(folders)
+
+            if number % (extensions_every * 10) == 0:
+                make_library(folder, f'lib{number}')
+
+            elif number % extensions_every == 0:
+                make_module(folder, f'mod{number}')
+
+    return folders[1:]
+
+
+def make_search_path(root: Path, entries: int) -> List[str]:
+    "Creates `entries` folders of Python modules to be used as `sys.path`."
+    search_path = []
+
+    for index in range(entries):
+        folder = root / f'site{index}'
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f'module{index}.py').write_text('')
+        search_path.append(str(folder))
+
+    return search_path
+
+
+def age(folder: Path, seconds: float = 3600) -> None:
+    """
+    Moves the modification times of every file in a folder into the past.
+    Nimporter does not trust the modification times of files modified within
+    the last few seconds so freshly generated files would always be hashed.
+    """
+    past = time.time() - seconds
+
+    for item in folder.rglob('*'):
+        os.utime(item, (past, past))
+    return
@@ -1,21 +1,42 @@
-import sys
-import os
-from icecream import ic, colorama
+"""
+Importing Nimporter registers the import hooks needed to import Nim extensions.
 
-ic.configureOutput(
-    includeContext=True,
-    prefix=f'{colorama.Fore.CYAN}ic|{colorama.Fore.RESET} ',
-
-    # https://github.com/gruns/icecream/issues/35#issuecomment-908730426
-    outputFunction=lambda *args: print(*args)
-)
-
-ic.enabled = 'NIMPORTER_INSTRUMENT' in os.environ
+Only the import hooks are loaded up front so that importing Nimporter stays
+cheap. Packaging helpers such as `get_nim_extensions()` pull in setuptools and
+are imported on first use.
+"""
 
+from typing import Any, List
 from nimporter.lib import (
     WINDOWS, MACOS, LINUX, EXT_DIR, PLATFORM_TABLE, ARCH_TABLE
 )
 
 import nimporter.nimporter  # Register importers
+from nimporter.nimporter import lazy_import, warm_up
+from nimporter.trace import add_hook, remove_hook
+
+# Imported on first access by `__getattr__()`
+_LAZY_ATTRIBUTES = {
+    'get_nim_extensions': 'nimporter.nexporter',
+    'ParallelBuildExt': 'nimporter.nexporter',
+}
+
+__all__ = [
+    'WINDOWS', 'MACOS', 'LINUX', 'EXT_DIR', 'PLATFORM_TABLE', 'ARCH_TABLE',
+    'lazy_import', 'warm_up', 'add_hook', 'remove_hook', 'get_nim_extensions',
+    'ParallelBuildExt',
+]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    import importlib
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
 
-from nimporter.nexporter import get_nim_extensions
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
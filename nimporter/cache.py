@@ -0,0 +1,657 @@
+"""
+Shares build artifacts between source trees using a content-addressed cache.
+
+Artifacts are normally only stored in the `__pycache__` next to each extension
+so every checkout, CI workspace and container would compile the same extension
+from scratch. The artifact cache stores each artifact in the cache directory
+(`NIMPORTER_CACHE_DIR` or the platform's user cache directory) keyed by the
+hash of the extension, every Nim module it imports and everything else that
+affects the build. Cached artifacts are installed with a hard link (or a copy
+if that is not possible) and renamed into place atomically.
+
+The cache is bounded by `NIMPORTER_CACHE_MAX_SIZE` (bytes, or with a K/M/G
+suffix) and evicts the least recently used artifacts beyond that. Setting it
+to 0 disables the cache.
+
+The nimcache of each extension (Nim's generated and compiled C code) is also
+kept in the cache directory between builds so that the C compiler only needs
+to recompile the translation units that changed. Nimcaches of extensions that
+no longer exist are removed with `prune_nimcaches()`.
+
+Artifacts can also be shared between machines using a remote cache configured
+with `NIMPORTER_REMOTE_CACHE` (a directory, `file://` or `http(s)://` URL) or
+`set_remote_cache()`. Remote artifacts are verified against their content hash
+and remote requests taking longer than `NIMPORTER_REMOTE_CACHE_TIMEOUT`
+seconds are abandoned in favor of building locally.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+from typing import *
+from pathlib import Path
+from nimporter.instrument import ic
+from nimporter.lib import (
+    PYTHON_LIB_EXT,
+    NimporterException,
+    get_cache_dir,
+    get_nim_version,
+    get_nimpy_version,
+    get_c_compiler_used_to_build_python,
+    file_lock,
+    write_atomically,
+)
+
+DEFAULT_CACHE_MAX_SIZE: int = 1024 ** 3  # 1 GiB
+SIZE_SUFFIXES: Dict[str, int] = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+STATS: Tuple[str, ...] = (
+    'hits', 'misses', 'evictions', 'remote_hits', 'remote_misses'
+)
+DEFAULT_REMOTE_CACHE_TIMEOUT: float = 10.0
+NIMCACHE_SOURCE: str = 'nimporter-source.json'
+
+
+def get_cache_max_size() -> int:
+    "Returns the maximum size in bytes of the artifact cache."
+    max_size = os.environ.get('NIMPORTER_CACHE_MAX_SIZE', '').strip().upper()
+
+    if not max_size:
+        return DEFAULT_CACHE_MAX_SIZE
+
+    max_size = max_size[:-1] if max_size.endswith('B') else max_size
+    multiplier = SIZE_SUFFIXES.get(max_size[-1:], 1)
+    return int(float(max_size.rstrip('KMG') or 0) * multiplier)
+
+
+def is_cache_enabled() -> bool:
+    return get_cache_max_size() > 0
+
+
+def get_artifacts_dir() -> Path:
+    return get_cache_dir() / 'artifacts'
+
+
+def get_build_key(
+    symbol: str,
+    source_hash: bytes,
+    build_args: List[str]
+) -> str:
+    """
+    Identifies a build artifact by everything that affects its contents.
+
+    Args:
+        symbol(str): the name of the extension which names its init function.
+        source_hash(bytes): the hash of the extension.
+        build_args(list): the Nim CLI arguments used to build the extension.
+
+    Returns:
+        A hex digest of the extension name and hash, Nim version, Nimpy
+        version, C compiler, build arguments and Python extension suffix.
+    """
+    key = json.dumps([
+        symbol,
+        source_hash.hex(),
+        get_nim_version(),
+        get_nimpy_version(),
+        get_c_compiler_used_to_build_python(),
+        build_args,
+        PYTHON_LIB_EXT,
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_artifact_path(build_key: str) -> Path:
+    return get_artifacts_dir() / build_key[:2] / f'{build_key}{PYTHON_LIB_EXT}'
+
+
+def get_record_path(input_key: str) -> Path:
+    return get_artifacts_dir() / input_key[:2] / f'{input_key}.json'
+
+
+def install_file(source: Path, destination: Path) -> None:
+    """
+    Hard links (or copies) a file to a temporary file next to the destination
+    and renames it into place so that the destination is never observed
+    partially written.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destination.with_name(
+        f'{destination.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    )
+
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copy2(source, tmp)
+
+    os.replace(tmp, destination)
+    return
+
+
+def fetch_artifact(build_key: str, destination: Path) -> bool:
+    """
+    Installs a cached build artifact.
+
+    Args:
+        build_key(str): the key of the artifact returned by `get_build_key()`.
+        destination(Path): where to install the artifact.
+
+    Returns:
+        Whether the artifact was in the cache.
+    """
+    if not is_cache_enabled():
+        return False
+
+    cached_artifact = get_artifact_path(build_key)
+
+    try:
+        # Touching the artifact marks it as recently used for eviction
+        os.utime(cached_artifact)
+        install_file(cached_artifact, destination)
+    except OSError:
+        record_stat('misses')
+        return False
+
+    record_stat('hits')
+    ic('Cache hit', build_key)
+    return True
+
+
+def store_artifact(build_key: str, artifact: Path) -> None:
+    """
+    Adds a build artifact to the cache and evicts the least recently used
+    artifacts if the cache grew too large. Failing to cache is not an error.
+    """
+    if not is_cache_enabled():
+        return
+
+    try:
+        install_file(artifact, get_artifact_path(build_key))
+    except OSError as error:
+        ic('Could not cache artifact', error)
+        return
+
+    evict_artifacts()
+    return
+
+
+def fetch_record(input_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the dependency record of a build from the local cache or else the
+    remote cache.
+
+    The modules an extension imports are only known once it is compiled so
+    artifacts are found in two steps. The inputs known before compiling are
+    the key of a record listing the dependencies the last build of those
+    inputs found. Hashing the dependencies then completes the key of the
+    artifact.
+
+    Args:
+        input_key(str): the key returned by `get_build_key()` for the inputs
+            known before compiling.
+
+    Returns:
+        The record given to `store_record()` or None if there is none.
+    """
+    if is_cache_enabled():
+        try:
+            return json.loads(get_record_path(input_key).read_text())
+        except (OSError, ValueError):
+            "Not built on this machine"
+
+    backend = get_remote_cache()
+
+    if not backend:
+        return None
+
+    def download() -> Optional[bytes]:
+        return backend.get(f'deps/{input_key}') # type: ignore[union-attr]
+
+    blob = call_with_timeout(download, get_remote_cache_timeout())
+
+    try:
+        return json.loads(blob) if blob else None
+    except ValueError:
+        return None
+
+
+def store_record(input_key: str, record: Dict[str, Any]) -> None:
+    """
+    Stores the dependency record of a build in the local cache and uploads it
+    to the remote cache in the background. See `fetch_record()`.
+    """
+    data = json.dumps(record).encode()
+
+    if is_cache_enabled():
+        write_atomically(get_record_path(input_key), data)
+
+    backend = get_remote_cache()
+
+    if not backend:
+        return
+
+    def upload() -> None:
+        backend.put(f'deps/{input_key}', data) # type: ignore[union-attr]
+        return
+
+    run_upload(upload, background=True)
+    return
+
+
+def iterate_artifacts() -> Iterator[Tuple[Path, os.stat_result]]:
+    for item in get_artifacts_dir().glob(f'*/*{PYTHON_LIB_EXT}'):
+        try:
+            yield item, item.stat()
+        except OSError:
+            "Evicted by another process"
+
+
+def evict_artifacts(max_size: Optional[int] = None) -> int:
+    """
+    Removes the least recently used artifacts until the cache fits.
+
+    Args:
+        max_size(int): the size in bytes to shrink the cache to. Defaults to
+            `get_cache_max_size()`.
+
+    Returns:
+        The number of evicted artifacts.
+    """
+    max_size = get_cache_max_size() if max_size is None else max_size
+    artifacts = sorted(iterate_artifacts(), key=lambda item: item[1].st_mtime)
+    size = sum(stat.st_size for _, stat in artifacts)
+    evictions = 0
+
+    for artifact, stat in artifacts:
+        if size <= max_size:
+            break
+
+        try:
+            artifact.unlink()
+        except OSError:
+            continue
+
+        size -= stat.st_size
+        evictions += 1
+
+    if evictions:
+        record_stat('evictions', evictions)
+
+    return evictions
+
+
+def read_stats() -> Dict[str, int]:
+    try:
+        stats = json.loads((get_cache_dir() / 'stats.json').read_text())
+    except (OSError, ValueError):
+        stats = {}
+
+    return {name: int(stats.get(name, 0)) for name in STATS}
+
+
+def record_stat(name: str, count: int = 1) -> None:
+    "Locked so that concurrent processes do not lose each other's increments."
+    try:
+        with file_lock(get_cache_dir() / 'stats.lock'):
+            stats = read_stats()
+            stats[name] += count
+            write_atomically(
+                get_cache_dir() / 'stats.json', json.dumps(stats).encode()
+            )
+    except OSError as error:
+        ic('Could not record cache statistics', error)
+    return
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    "Summarizes the contents and effectiveness of the artifact cache."
+    artifacts = list(iterate_artifacts())
+
+    return dict(
+        directory=str(get_artifacts_dir()),
+        artifacts=len(artifacts),
+        size=sum(stat.st_size for _, stat in artifacts),
+        max_size=get_cache_max_size(),
+        **read_stats()
+    )
+
+
+def clear_cache() -> None:
+    "Removes every cached artifact and resets the counters."
+    shutil.rmtree(get_artifacts_dir(), ignore_errors=True)
+
+    try:
+        (get_cache_dir() / 'stats.json').unlink()
+    except OSError:
+        "Already cleared"
+    return
+
+
+def get_nimcaches_dir() -> Path:
+    return get_cache_dir() / 'nimcache'
+
+
+def get_nimcache_path(source: Path, build_args: List[str]) -> Path:
+    """
+    Returns the nimcache of an extension. Each combination of build arguments
+    gets its own nimcache so that switching between them never invalidates
+    the compiled C code of the other.
+    """
+    key = json.dumps([str(source.absolute()), build_args])
+    return get_nimcaches_dir() / hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def use_nimcache(source: Path, build_args: List[str]) -> Iterator[Path]:
+    """
+    Provides the nimcache to compile an extension with. This is a temporary
+    directory if the cache is disabled.
+
+    Args:
+        source(Path): the extension module or library being compiled.
+        build_args(list): the Nim CLI arguments used to build the extension.
+    """
+    if not is_cache_enabled():
+        with tempfile.TemporaryDirectory() as tmp:
+            yield Path(tmp)
+        return
+
+    nimcache = get_nimcache_path(source, build_args)
+    nimcache.mkdir(parents=True, exist_ok=True)
+
+    # Remembers which extension the nimcache belongs to for pruning
+    write_atomically(
+        nimcache / NIMCACHE_SOURCE,
+        json.dumps(dict(source=str(source.absolute()))).encode()
+    )
+
+    yield nimcache
+
+
+def prune_nimcaches(everything: bool = False) -> int:
+    """
+    Removes the nimcaches of extensions that no longer exist.
+
+    Args:
+        everything(bool): remove every nimcache regardless.
+
+    Returns:
+        The number of removed nimcaches.
+    """
+    if not get_nimcaches_dir().exists():
+        return 0
+
+    pruned = 0
+
+    for nimcache in get_nimcaches_dir().iterdir():
+        try:
+            record = json.loads((nimcache / NIMCACHE_SOURCE).read_text())
+            source = Path(record['source'])
+        except (OSError, ValueError, KeyError):
+            source = None
+
+        if everything or source is None or not source.exists():
+            ic('Pruning', nimcache, source)
+            shutil.rmtree(nimcache, ignore_errors=True)
+            pruned += 1
+
+    return pruned
+
+
+class CacheBackend:
+    """
+    A store of build artifacts shared between machines.
+
+    Backends only need to get and put blobs by name. Artifacts are stored as
+    two blobs: `cas/<sha256 of the artifact>` containing the artifact itself
+    and `ac/<build key>` containing the SHA-256 hex digest of the artifact.
+    This allows verifying the integrity of every downloaded artifact.
+    """
+    def get(self, name: str) -> Optional[bytes]:
+        "Returns the blob of the given name or None if it does not exist."
+        raise NotImplementedError
+
+    def put(self, name: str, data: bytes) -> None:
+        "Stores a blob under the given name."
+        raise NotImplementedError
+
+
+class FileSystemBackend(CacheBackend):
+    "Stores blobs in a (typically network mounted) directory."
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        return
+
+    def get(self, name: str) -> Optional[bytes]:
+        try:
+            return (self.root / name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, data: bytes) -> None:
+        if not write_atomically(self.root / name, data):
+            raise NimporterException(f'Could not write {self.root / name}')
+        return
+
+
+class HttpBackend(CacheBackend):
+    "Stores blobs on a web server using GET and PUT requests."
+    def __init__(
+        self,
+        url: str,
+        timeout: float = DEFAULT_REMOTE_CACHE_TIMEOUT
+    ) -> None:
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        return
+
+    def get(self, name: str) -> Optional[bytes]:
+        import urllib.error
+        import urllib.request
+
+        try:
+            url = f'{self.url}/{name}'
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                return None
+            raise
+
+    def put(self, name: str, data: bytes) -> None:
+        import urllib.request
+
+        request = urllib.request.Request(
+            f'{self.url}/{name}',
+            data=data,
+            method='PUT',
+            headers={'Content-Type': 'application/octet-stream'}
+        )
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+        return
+
+
+_REMOTE_CACHE: List[Optional[CacheBackend]] = []
+
+
+def set_remote_cache(backend: Optional[CacheBackend]) -> None:
+    "Overrides the remote cache configured by `NIMPORTER_REMOTE_CACHE`."
+    _REMOTE_CACHE[:] = [backend]
+    return
+
+
+def get_remote_cache() -> Optional[CacheBackend]:
+    "Returns the remote cache backend in use or None if there is none."
+    if _REMOTE_CACHE:
+        return _REMOTE_CACHE[0]
+
+    url = os.environ.get('NIMPORTER_REMOTE_CACHE', '')
+
+    if url.startswith(('http://', 'https://')):
+        return HttpBackend(url, get_remote_cache_timeout())
+    elif url.startswith('file://'):
+        return FileSystemBackend(Path(url[len('file://'):]))
+    elif url:
+        return FileSystemBackend(Path(url).expanduser())
+
+    return None
+
+
+def get_remote_cache_timeout() -> float:
+    return float(
+        os.environ.get('NIMPORTER_REMOTE_CACHE_TIMEOUT')
+        or DEFAULT_REMOTE_CACHE_TIMEOUT
+    )
+
+
+T = TypeVar('T')
+
+
+def call_with_timeout(function: Callable[[], T], timeout: float) -> Optional[T]:
+    """
+    Calls a function on a daemon thread and stops waiting for it after the
+    timeout. Errors are logged rather than raised since the remote cache is
+    only ever an optimization.
+
+    Returns:
+        The result of the function or None if it failed or timed out.
+    """
+    result: List[T] = []
+
+    def call() -> None:
+        try:
+            result.append(function())
+        except Exception as error:
+            ic('Remote cache error', error)
+        return
+
+    thread = threading.Thread(target=call, name='nimporter-cache', daemon=True)
+    thread.start()
+    thread.join(timeout)
+
+    if thread.is_alive():
+        ic(f'Remote cache did not respond within {timeout} seconds')
+
+    return result[0] if result else None
+
+
+def fetch_remote_artifact(build_key: str, destination: Path) -> bool:
+    """
+    Downloads a build artifact from the remote cache and verifies it.
+
+    Args:
+        build_key(str): the key of the artifact returned by `get_build_key()`.
+        destination(Path): where to install the artifact.
+
+    Returns:
+        Whether a valid artifact was downloaded in time.
+    """
+    backend = get_remote_cache()
+
+    if not backend:
+        return False
+
+    def download() -> Optional[bytes]:
+        digest = backend.get(f'ac/{build_key}') # type: ignore[union-attr]
+
+        if not digest:
+            return None
+
+        digest_hex = digest.decode(errors='ignore').strip()
+        artifact = backend.get(f'cas/{digest_hex}') # type: ignore[union-attr]
+
+        if artifact is None:
+            return None
+
+        if hashlib.sha256(artifact).hexdigest() != digest_hex:
+            ic('Remote artifact is corrupt', build_key)
+            return None
+
+        return artifact
+
+    artifact = call_with_timeout(download, get_remote_cache_timeout())
+
+    if artifact is None or not write_atomically(destination, artifact):
+        record_stat('remote_misses')
+        return False
+
+    record_stat('remote_hits')
+    ic('Remote cache hit', build_key)
+    return True
+
+
+_UPLOADS: List[threading.Thread] = []
+
+
+def store_remote_artifact(
+    build_key: str,
+    artifact: Path,
+    background: bool = False
+) -> None:
+    """
+    Uploads a build artifact to the remote cache if there is one and it does
+    not already have it.
+
+    Args:
+        build_key(str): the key of the artifact returned by `get_build_key()`.
+        artifact(Path): the artifact to upload.
+        background(bool): upload on a background thread rather than waiting
+            for it. See `run_upload()`.
+    """
+    backend = get_remote_cache()
+
+    if not backend:
+        return
+
+    # Read now since the artifact could be rebuilt while uploading
+    data = artifact.read_bytes()
+
+    def upload() -> None:
+        # Another machine already uploaded it
+        if backend.get(f'ac/{build_key}'): # type: ignore[union-attr]
+            return
+
+        digest_hex = hashlib.sha256(data).hexdigest()
+
+        # Upload the artifact before the key that refers to it
+        backend.put(f'cas/{digest_hex}', data) # type: ignore[union-attr]
+        backend.put(f'ac/{build_key}', digest_hex.encode()) # type: ignore[union-attr]
+        return
+
+    run_upload(upload, background)
+    return
+
+
+def run_upload(upload: Callable[[], None], background: bool) -> None:
+    """
+    Uploads to the remote cache on a background thread or waits for it. The
+    interpreter waits for background uploads (up to the remote cache timeout)
+    before exiting.
+    """
+    timeout = get_remote_cache_timeout()
+
+    if not background:
+        call_with_timeout(upload, timeout)
+        return
+
+    thread = threading.Thread(
+        target=call_with_timeout,
+        args=(upload, timeout),
+        name='nimporter-upload'
+    )
+    thread.start()
+    _UPLOADS.append(thread)
+    return
+
+
+def wait_for_uploads(timeout: Optional[float] = None) -> None:
+    "Waits for the background uploads to the remote cache to finish."
+    for thread in list(_UPLOADS):
+        thread.join(timeout)
+
+    _UPLOADS[:] = [thread for thread in _UPLOADS if thread.is_alive()]
+    return
@@ -14,6 +14,9 @@ from pathlib import Path
 from cookiecutter.main import cookiecutter
 from nimporter.lib import *
 from nimporter.nimporter import *
+from nimporter.cache import clear_cache, get_cache_stats, prune_nimcaches
+from nimporter.pgo import compile_extensions_with_pgo
+from nimporter.freeze import MANIFEST_FILENAME, freeze
 
 # TODO(pbz): Need to move this to a doc/tutorial
 SETUPPY_TEMPLATE: str = f'''
@@ -109,33 +112,83 @@ def nimporter_init(extension_type: str, extension_name: str) -> None:
     return
 
 
-def nimporter_compile() -> None:
-    def current_time_ms() -> float:
-        return round(time.time() * 1000)
-
-    overall_start = current_time_ms()
+def nimporter_compile(
+    jobs: Optional[int] = None,
+    profile: Optional[str] = None,
+    pgo: Optional[str] = None
+) -> None:
+    jobs = get_job_count(jobs)
+    overall_start = time.perf_counter()
 
     nimporter_clean(Path())
 
-    for ext in find_extensions(Path()):
+    extensions = with_cpu_variants(
+        [get_ext_lib(ext, Path()) for ext in find_extensions(Path())]
+    )
+
+    print(f'Building {len(extensions)} Extensions using {jobs} jobs')
+
+    total_build_time = 0.0
+    builds = (
+        compile_extensions_with_pgo(extensions, pgo, jobs, profile) if pgo
+        else compile_extensions_concurrently(extensions, jobs, profile)
+    )
+
+    for ext, build_time in builds:
+        total_build_time += build_time
         print(
-            f'Building Extension {"Lib" if ext.is_dir() else "Mod"}: '
-            f'{ext.name}'
+            f'Built Extension {"Lib" if ext.library else "Mod"}: '
+            f'{ext.symbol}'
+            f'{f" [{ext.cpu_variant}]" if ext.cpu_variant else ""} in '
+            f'{round(build_time * 1000)} ms'
         )
 
-        start = current_time_ms()
-        module_path = ext if ext.is_file() else ext / f'{ext.name}.nim'
-        compile_extension_to_lib(ExtLib(module_path, Path(), ext.is_dir()))
-        print('  Completed in', current_time_ms() - start, 'ms')
+    overall_time = time.perf_counter() - overall_start
 
+    print('Completed all in', round(overall_time, 3), 'seconds')
     print(
-        'Completed all in',
-        (current_time_ms() - overall_start) / 1000.0,
-        'seconds'
+        f'Speedup: {total_build_time / max(overall_time, 1e-9):.2f}x over '
+        f'building one at a time ({round(total_build_time, 3)} seconds)'
     )
     return
 
 
+def nimporter_freeze(
+    output: Path,
+    jobs: Optional[int] = None,
+    profile: Optional[str] = None
+) -> None:
+    manifest = freeze(Path(), output, get_job_count(jobs), profile)
+
+    for name, entry in manifest['extensions'].items():
+        for artifact in entry['artifacts']:
+            variant = artifact['cpu_variant']
+            print(
+                f'Froze {name}{f" [{variant}]" if variant else ""}: '
+                f'{artifact["artifact"]}'
+            )
+
+    print(f'Wrote {output}. Define NIMPORTER_FROZEN=1 to import from it')
+    return
+
+
+def nimporter_cache(action: str, everything: bool = False) -> None:
+    if action == 'stats':
+        stats = get_cache_stats()
+        width = max(len(name) for name in stats)
+
+        for name, value in stats.items():
+            print(f'{name.replace("_", " ").title():<{width}}  {value}')
+
+    elif action == 'clear':
+        print('Clearing', get_cache_stats()['directory'])
+        clear_cache()
+
+    elif action == 'prune':
+        print('Pruned', prune_nimcaches(everything), 'nimcaches')
+    return
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Nimporter CLI')
     subs = parser.add_subparsers(dest='cmd', required=True)
@@ -172,10 +225,100 @@ def build_parser() -> argparse.ArgumentParser:
     )
 
     # Compile command
-    subs.add_parser(
+    compile_ = subs.add_parser(
         'compile',
         help='Precompile all extensions exactly as if they were imported'
     )
+    compile_.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help=(
+            'Number of extensions to build at once. Defaults to the '
+            'NIMPORTER_JOBS environment variable or the number of CPUs. The '
+            'CPUs are shared between jobs so the machine is not oversubscribed'
+        )
+    )
+    compile_.add_argument(
+        '-p',
+        '--profile',
+        type=str,
+        default=None,
+        help=(
+            'Build profile to compile every extension with (debug, release, '
+            'danger, size or one defined in [tool.nimporter.profiles]). '
+            'Defaults to the NIMPORTER_PROFILE environment variable or the '
+            'profile configured in pyproject.toml'
+        )
+    )
+    compile_.add_argument(
+        '--pgo',
+        type=str,
+        default=None,
+        metavar='TRAINING_COMMAND',
+        help=(
+            'Use profile-guided optimization (GCC only): build instrumented '
+            'extensions, run this command to exercise them (e.g. '
+            '"python bench.py") and rebuild them using the recorded profile. '
+            'Profiles are reused until the extensions change'
+        )
+    )
+
+    # Freeze command
+    freeze_ = subs.add_parser(
+        'freeze',
+        help=(
+            'Compile all extensions and write the manifest imported from when '
+            'NIMPORTER_FROZEN is defined, skipping all checks for changes'
+        )
+    )
+    freeze_.add_argument(
+        '-o',
+        '--output',
+        type=Path,
+        default=Path(MANIFEST_FILENAME),
+        help=(
+            'Where to write the manifest. Defaults to '
+            f'{MANIFEST_FILENAME}. Set NIMPORTER_MANIFEST to this path when '
+            'running from another directory'
+        )
+    )
+    freeze_.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='Number of extensions to build at once'
+    )
+    freeze_.add_argument(
+        '-p',
+        '--profile',
+        type=str,
+        default=None,
+        help='Build profile to compile every extension with'
+    )
+
+    # Cache command
+    cache = subs.add_parser(
+        'cache',
+        help='Inspect or clear the build artifact cache shared between projects'
+    )
+    cache.add_argument(
+        'action',
+        choices=['stats', 'clear', 'prune'],
+        help=(
+            '`stats` shows the size and hit/miss/eviction counts of the cache, '
+            '`clear` removes every cached artifact, `prune` removes the '
+            'nimcaches of extensions that no longer exist'
+        )
+    )
+    cache.add_argument(
+        '--all',
+        action='store_true',
+        dest='everything',
+        help='With `prune`, remove every nimcache'
+    )
 
     return parser
 
@@ -196,7 +339,13 @@ def main(cli_args: Optional[List[str]] = None) -> int:
         # nimporter_bundle(args.exp)
 
     elif args.cmd == 'compile':
-        nimporter_compile()
+        nimporter_compile(args.jobs, args.profile, args.pgo)
+
+    elif args.cmd == 'freeze':
+        nimporter_freeze(args.output, args.jobs, args.profile)
+
+    elif args.cmd == 'cache':
+        nimporter_cache(args.action, args.everything)
 
     elif args.cmd == 'init':
         nimporter_init(args.extension_type, args.extension_name)
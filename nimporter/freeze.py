@@ -0,0 +1,176 @@
+"""
+Freezes the extensions of a project for production.
+
+`nimporter freeze` compiles every extension of a project and writes a manifest
+mapping the import name of each extension to its build artifact along with
+the hash of its source, its build key and the toolchain that built it.
+
+Defining `NIMPORTER_FROZEN=1` in the environment then imports extensions
+straight from the manifest (found at `NIMPORTER_MANIFEST` or in the current
+directory): no source is hashed, `sys.path` is not searched and the compiler
+is never invoked. Importing a Nim extension that is not in the manifest raises
+CompilationDisabledException rather than compiling it.
+"""
+
+import os
+import json
+import platform
+from typing import *
+from pathlib import Path
+from nimporter.instrument import ic
+from nimporter.lib import (
+    PYTHON_LIB_EXT,
+    NimporterException,
+    find_extensions,
+    get_ext_lib,
+    get_extension_hash,
+    get_nim_version,
+    get_c_compiler_used_to_build_python,
+    get_cpu_variant_tag,
+    is_cpu_variant_supported,
+)
+
+MANIFEST_FILENAME: str = 'nimporter-manifest.json'
+MANIFEST_VERSION: int = 1
+
+
+def is_frozen() -> bool:
+    "Frozen mode is enabled by defining NIMPORTER_FROZEN in the environment."
+    return os.environ.get('NIMPORTER_FROZEN', '0') not in ('', '0')
+
+
+def get_manifest_path() -> Path:
+    return Path(os.environ.get('NIMPORTER_MANIFEST') or MANIFEST_FILENAME)
+
+
+def freeze(
+    root: Path,
+    output: Path,
+    jobs: int = 1,
+    profile: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Compiles every stale extension starting at a given path and writes the
+    manifest used by frozen mode.
+
+    Args:
+        root(Path): the folder to search for extensions, which is also the
+            folder import names are relative to.
+        output(Path): where to write the manifest. Artifact paths are stored
+            relative to it so the project can be moved as a whole.
+        jobs(int): the number of extensions to build at once.
+        profile(str): the build profile to use instead of the configured one.
+
+    Returns:
+        The manifest that was written.
+    """
+    from nimporter.nimporter import (
+        compile_extensions_to_lib,
+        get_artifact_key,
+        get_build_args,
+        read_dependencies,
+        with_cpu_variants,
+    )
+
+    compile_extensions_to_lib(root, jobs, profile)
+    manifest_dir = output.resolve().absolute().parent
+    extensions: Dict[str, Any] = {}
+
+    for extension_path in find_extensions(root):
+        baseline = get_ext_lib(extension_path, root)
+        artifacts = []
+
+        # Variants are listed most specialized first, then the baseline
+        for ext in reversed(with_cpu_variants([baseline])):
+            _, source_hash = get_extension_hash(ext.relative_path)
+            build_key = get_artifact_key(
+                ext,
+                source_hash,
+                read_dependencies(ext),
+                get_build_args(ext, profile) + ext.cpu_args
+            )
+            artifacts.append(dict(
+                cpu_variant=ext.cpu_variant,
+                cpu_variant_tag=(
+                    ext.cpu_variant and get_cpu_variant_tag(ext.cpu_variant)
+                ),
+                artifact=Path(os.path.relpath(
+                    ext.build_artifact, manifest_dir
+                )).as_posix(),
+                source_hash=source_hash.hex(),
+                build_key=build_key,
+            ))
+
+        extensions[baseline.import_namespace] = dict(
+            library=baseline.library,
+            artifacts=artifacts,
+        )
+
+    manifest = dict(
+        version=MANIFEST_VERSION,
+        toolchain=dict(
+            nim=get_nim_version(),
+            cc=get_c_compiler_used_to_build_python(),
+            platform=platform.system().lower(),
+            python_lib_ext=PYTHON_LIB_EXT,
+        ),
+        extensions=extensions,
+    )
+
+    output.write_text(json.dumps(manifest, indent=4))
+    return manifest
+
+
+def select_artifact(entry: Dict[str, Any]) -> Dict[str, Any]:
+    "Returns the most specialized artifact of an extension the CPU can run."
+    for artifact in entry['artifacts']:
+        variant = artifact['cpu_variant']
+
+        if not variant or (
+            is_cpu_variant_supported(variant)
+            and get_cpu_variant_tag(variant) == artifact['cpu_variant_tag']
+        ):
+            return artifact
+
+    raise NimporterException('Frozen extension has no baseline artifact')
+
+
+def read_manifest(path: Path) -> Dict[str, Path]:
+    """
+    Reads the manifest written by `freeze()`.
+
+    Returns:
+        The absolute path of the artifact to import for each import name.
+
+    Raises:
+        NimporterException if the manifest is missing or was frozen for
+        another version of Python.
+    """
+    try:
+        manifest = json.loads(path.read_text())
+    except (OSError, ValueError) as error:
+        raise NimporterException(
+            f'Nimporter is frozen (NIMPORTER_FROZEN) but its manifest could '
+            f'not be read. Run `nimporter freeze` to create it: {error}'
+        ) from error
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise NimporterException(
+            f'{path} was written by another version of Nimporter. Run '
+            '`nimporter freeze` again.'
+        )
+
+    python_lib_ext = manifest['toolchain']['python_lib_ext']
+
+    if python_lib_ext != PYTHON_LIB_EXT:
+        raise NimporterException(
+            f'{path} was frozen for {python_lib_ext} extensions but this '
+            f'Python imports {PYTHON_LIB_EXT} extensions.'
+        )
+
+    manifest_dir = path.resolve().absolute().parent
+
+    return ic({
+        name: manifest_dir / select_artifact(entry)['artifact']
+        for name, entry in manifest['extensions'].items()
+    })
@@ -0,0 +1,33 @@
+"""
+Instrumentation output, enabled by setting the NIMPORTER_INSTRUMENT environment
+variable.
+
+IceCream and its dependencies take longer to import than the rest of Nimporter
+combined, so they are only imported when instrumentation is enabled. Otherwise
+`ic` is a stand-in that returns its arguments just like IceCream would.
+"""
+
+import os
+from typing import *
+
+
+def _passthrough(*args: Any) -> Any:
+    "Returns its arguments the same way `icecream.ic` does, without printing."
+    if not args:
+        return None
+
+    return args[0] if len(args) == 1 else args
+
+
+ic: Any = _passthrough
+
+if 'NIMPORTER_INSTRUMENT' in os.environ:
+    from icecream import ic, colorama  # type: ignore
+
+    ic.configureOutput(
+        includeContext=True,
+        prefix=f'{colorama.Fore.CYAN}ic|{colorama.Fore.RESET} ',
+
+        # https://github.com/gruns/icecream/issues/35#issuecomment-908730426
+        outputFunction=lambda *args: print(*args)
+    )
@@ -1,19 +1,25 @@
 import os
 import sys
+import copy
+import json
+import time
 import shlex
 import shutil
+import fnmatch
 import hashlib
+import threading
 import tempfile
 import platform
 import sysconfig
 import subprocess
-import cpuinfo
 from typing import *
 from pathlib import Path
 from contextlib import contextmanager
-from icecream import ic
+from nimporter.instrument import ic
+from nimporter.trace import span
 
 PathParts = Union[Tuple[str, str, str], Tuple[str], Tuple[str, str]]
+Fingerprint = List[Tuple[str, int, int, int]]
 
 PYTHON: str = 'python' if sys.platform == 'win32' else 'python3'
 PIP: str = 'pip' if shutil.which('pip') else 'pip3'
@@ -23,6 +29,17 @@ MACOS: str = 'darwin'
 LINUX: str = 'linux'
 EXT_DIR: str = 'nim-extensions'
 
+# Files of extension libraries which affect their build. The C sources and
+# headers are those a library can compile along with its Nim code.
+DEFAULT_HASH_INCLUDE: Tuple[str, ...] = (
+    '*.nim', '*.nims', '*.nimble', '*.cfg', '*.c', '*.h'
+)
+DEFAULT_HASH_IGNORE: Tuple[str, ...] = (
+    '__pycache__', '.git', '.hg', '.svn', 'nimcache', 'nimbledeps'
+)
+HASH_BLOCK_SIZE: int = 1024 * 1024
+PARALLEL_HASH_MIN_SIZE: int = 16 * 1024 * 1024
+
 PLATFORM_TABLE: Dict[str, str] = {  # Keys are known to Python and values are Nim-understood
     'windows': 'Windows',
     'darwin': 'MacOSX',
@@ -57,6 +74,50 @@ ALWAYS_ARGS: List['str'] = [
     '--warning[ProveInit]:off',  # https://github.com/Pebaz/nimporter/issues/41
 ]
 
+# Used by profile-guided optimization. Every C file is recompiled since Nim
+# only recompiles those whose code changed.
+INSTRUMENT_ARGS: List[str] = [
+    '--forceBuild:on',
+    '--passC:-fprofile-generate',
+    '--passL:-fprofile-generate',
+]
+OPTIMIZE_ARGS: List[str] = [
+    '--forceBuild:on',
+    '--passC:-fprofile-use',
+    '--passC:-fprofile-correction',
+    '--passC:-Wno-missing-profile',
+]
+
+# Named sets of Nim options, selected per extension with `get_build_profile()`.
+# Custom profiles can be defined in `[tool.nimporter.profiles]` using the same
+# keys: `inherits`, `args`, `opt`, `mm`, `stack_trace`, `line_trace` & `lto`.
+BUILD_PROFILES: Dict[str, Dict[str, Any]] = {
+    'debug': {},
+    'release': {'args': ['-d:release'], 'opt': 'speed'},
+    'danger': {'args': ['-d:danger'], 'opt': 'speed'},
+    'size': {'args': ['-d:release'], 'opt': 'size'},
+}
+DEFAULT_BUILD_PROFILE: str = 'debug'
+
+# The CPU flags (as reported by cpuinfo) required to run each x86-64
+# microarchitecture level. Extensions can be built once per level with
+# `-march=<level>` in addition to the baseline build that runs anywhere.
+_X86_64_V2: FrozenSet[str] = frozenset({
+    'cx16', 'lahf_lm', 'popcnt', 'sse4_1', 'sse4_2', 'ssse3'
+})
+_X86_64_V3: FrozenSet[str] = _X86_64_V2 | {
+    'avx', 'avx2', 'bmi1', 'bmi2', 'f16c', 'fma', 'movbe', 'abm'
+}
+_X86_64_V4: FrozenSet[str] = _X86_64_V3 | {
+    'avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl'
+}
+CPU_VARIANTS: Dict[str, FrozenSet[str]] = {
+    'x86-64-v2': _X86_64_V2,
+    'x86-64-v3': _X86_64_V3,
+    'x86-64-v4': _X86_64_V4,
+    'native': frozenset(),  # Only runs on CPUs with the same flags
+}
+
 
 def find_extensions(path: Path) -> List[Path]:
     nim_exts = []
@@ -138,6 +199,7 @@ def convert_to_lib_if_needed(path: Path) -> Iterator[Path]:
 def run_process(
     process_args: List[str],
     show_output: bool = False,
+    cwd: Optional[Path] = None,
 ) -> Tuple[int, Union[bytes, Text], Union[bytes, Text]]:
     """
     Invokes the compiler (or any executable) and returns the output.
@@ -148,6 +210,9 @@ def run_process(
 
     Args:
         process_args(list): the arg being the executable and the rest are args.
+        show_output(bool): stream the output rather than capturing it.
+        cwd(Path): directory to run the process in. Prefer this over `cd()`
+            since changing the working directory is not thread safe.
 
     Returns:
         A tuple containing any errors, warnings, or hints from the
@@ -157,6 +222,7 @@ def run_process(
         process_args,
         stdout=None if show_output else subprocess.PIPE,
         stderr=None if show_output else subprocess.PIPE,
+        cwd=cwd,
     )
 
     code, out, err = process.returncode, process.stdout, process.stderr
@@ -177,51 +243,340 @@ def cd(path: Path) -> Iterator[Path]:
         os.chdir(cwd)
 
 
+def get_job_count(jobs: Optional[int] = None) -> int:
+    """
+    Returns how many builds to run at once.
+
+    An explicit job count wins, then the `NIMPORTER_JOBS` environment variable
+    and finally the number of CPUs on the machine. Zero (or None) is the same
+    as not giving a job count.
+    """
+    if jobs and jobs < 0:
+        raise NimporterException(f'The job count must be positive, not {jobs}')
+
+    if jobs:
+        return jobs
+
+    value = os.environ.get('NIMPORTER_JOBS', '').strip()
+
+    if value:
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+
+        if jobs < 1:
+            raise NimporterException(
+                f'NIMPORTER_JOBS must be a positive number of jobs, not '
+                f'{value!r}'
+            )
+
+        return jobs
+
+    return os.cpu_count() or 1
+
+
+def get_parallel_build(jobs: int) -> int:
+    """
+    Splits the CPUs of the machine between `jobs` concurrent Nim builds.
+
+    The result is meant for Nim's `--parallelBuild` switch so that N builds
+    each running M C compiler processes do not oversubscribe the machine.
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, jobs))
+
+
 def get_c_compiler_used_to_build_python() -> str:
     "This func is included just to be a bit clearer as to its significance."
     return 'vcc' if 'MSC' in sys.version else 'gcc'
 
 
+def get_cache_dir() -> Path:
+    """
+    Returns the directory Nimporter uses to cache data between processes.
+
+    This is `NIMPORTER_CACHE_DIR` if defined in the environment and otherwise
+    the user cache directory of the platform.
+    """
+    if os.environ.get('NIMPORTER_CACHE_DIR'):
+        return Path(os.environ['NIMPORTER_CACHE_DIR']).expanduser()
+
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or '~/AppData/Local'
+    elif sys.platform == 'darwin':
+        base = '~/Library/Caches'
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or '~/.cache'
+
+    return Path(base).expanduser() / 'nimporter'
+
+
+def get_nimble_dir() -> Path:
+    "Returns the directory Nimble installs packages into."
+    return Path(os.environ.get('NIMBLE_DIR') or '~/.nimble').expanduser()
+
+
+def get_host_key() -> List[Any]:
+    "Identifies the machine and Python interpreter running Nimporter."
+    return [platform.node(), platform.machine(), sys.executable]
+
+
+def get_toolchain_key() -> List[Any]:
+    """
+    Identifies the Nim toolchain available to Nimporter.
+
+    The key changes whenever the `nim` or `nimble` executables are replaced
+    (e.g. switching toolchains using Choosenim) or when Nimble packages are
+    installed or removed.
+    """
+    def stat(path: Optional[Union[str, Path]]) -> Optional[List[Any]]:
+        try:
+            return [os.path.realpath(path), os.stat(path).st_mtime_ns] # type: ignore[arg-type]
+        except (OSError, TypeError):
+            return None
+
+    nimble_dir = get_nimble_dir()
+
+    return get_host_key() + [
+        stat(shutil.which('nim')),
+        stat(shutil.which('nimble')),
+        stat(nimble_dir / 'pkgs'),
+        stat(nimble_dir / 'pkgs2'),
+    ]
+
+
+# Toolchain probes are loaded once per process and guarded by a reentrant lock
+# since probes can depend on other probes and builds can run concurrently.
+_TOOLCHAIN_LOCK = threading.RLock()
+_TOOLCHAIN_PROBES: Dict[str, Dict[str, Any]] = {}
+_TOOLCHAIN_KEYS: Dict[bool, List[Any]] = {}
+
+
+def probe_toolchain(
+    name: str,
+    probe: Callable[[], Optional[str]],
+    host_only: bool = False
+) -> Optional[str]:
+    """
+    Returns the result of an expensive query about the toolchain or host.
+
+    Results are persisted to `toolchain.json` in the cache directory along
+    with the toolchain key (or host key if `host_only`) at the time of the
+    query. The probe is only run again once that key changes.
+
+    Args:
+        name(str): the name of the value to probe.
+        probe(callable): computes the value. Results of None are not cached.
+        host_only(bool): whether the value only depends on the host machine
+            rather than on the Nim toolchain.
+
+    Returns:
+        The cached or freshly probed value.
+    """
+    with _TOOLCHAIN_LOCK:
+        if host_only not in _TOOLCHAIN_KEYS:
+            _TOOLCHAIN_KEYS[host_only] = (
+                get_host_key() if host_only else get_toolchain_key()
+            )
+
+        if not _TOOLCHAIN_PROBES:
+            try:
+                cache_file = get_cache_dir() / 'toolchain.json'
+                _TOOLCHAIN_PROBES.update(json.loads(cache_file.read_text()))
+            except (OSError, ValueError):
+                "No usable cache yet"
+
+        key = _TOOLCHAIN_KEYS[host_only]
+        cached = _TOOLCHAIN_PROBES.get(name)
+
+        if isinstance(cached, dict) and cached.get('key') == key:
+            return ic(cached.get('value'))
+
+        value = probe()
+
+        if value is not None:
+            _TOOLCHAIN_PROBES[name] = dict(key=key, value=value)
+            write_atomically(
+                get_cache_dir() / 'toolchain.json',
+                json.dumps(_TOOLCHAIN_PROBES, indent=4).encode()
+            )
+
+        return ic(value)
+
+
+def write_atomically(path: Path, data: bytes) -> bool:
+    """
+    Writes a file by renaming a temporary file into place so that concurrent
+    readers never observe a partially written file.
+
+    Returns:
+        Whether the file could be written. Failures (such as a read-only
+        cache directory) are not fatal for a cache.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        return False
+
+
+def move_atomically(source: Path, destination: Path) -> None:
+    """
+    Moves a file next to the destination and renames it into place so that
+    concurrent readers never observe a partially written file, even when the
+    source is on another file system.
+    """
+    tmp = destination.with_name(
+        f'{destination.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    )
+    shutil.move(str(source), str(tmp))
+    os.replace(tmp, destination)
+    return
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[float]:
+    """
+    Holds an exclusive lock on a file for the duration of the `with` block.
+    The lock is held against other processes as well as other threads.
+
+    Args:
+        path(Path): the lock file. It is created if needed and never removed
+            since removing it could let two processes hold the lock at once.
+
+    Yields:
+        The number of seconds spent waiting for the lock.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, 'a+b') as file:
+        with span('lock_wait', path=path) as details:
+            start = time.perf_counter()
+
+            if sys.platform == 'win32':
+                import msvcrt
+
+                # Locking gives up after trying for 10 seconds so keep trying
+                while True:
+                    try:
+                        file.seek(0)
+                        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        "Still locked"
+            else:
+                import fcntl
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+            waited = details['waited'] = time.perf_counter() - start
+
+        if waited > 0.1:
+            ic(f'Waited {waited:.2f} seconds for {path}')
+
+        try:
+            yield waited
+        finally:
+            if sys.platform == 'win32':
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    return
+
+
 def get_host_info() -> Tuple[str, str, str]:
     """
     Returns the host platform, architecture, and C compiler used to build the
     running Python process.
     """
-    # Calling get_cpu_info() is expensive
-    if not getattr(get_host_info, 'host_arch', None):
-        setattr(get_host_info, 'host_arch', cpuinfo.get_cpu_info()['arch'].lower())
-        # get_host_info.host_arch = cpuinfo.get_cpu_info()['arch'].lower()
+    def probe_host_arch() -> str:
+        import cpuinfo  # Calling get_cpu_info() is expensive
+        return cpuinfo.get_cpu_info()['arch'].lower()
 
     return ic((
         platform.system().lower(),
-        get_host_info.host_arch, # type: ignore[attr-defined]
+        probe_toolchain('host_arch', probe_host_arch, host_only=True),
         get_c_compiler_used_to_build_python()
     ))
 
 
-def ensure_nimpy() -> None:
+def get_nim_version() -> Optional[str]:
+    "Returns the version of the Nim compiler on the path if there is one."
+    def probe_nim_version() -> Optional[str]:
+        if not shutil.which('nim'):
+            return None
+
+        code, out, _ = run_process(['nim', '-v'])
+
+        if code or not out:
+            return None
+
+        # Nim Compiler Version 1.6.10 [Linux: amd64]
+        return out.splitlines()[0].split()[3] # type: ignore[return-value]
+
+    return probe_toolchain('nim_version', probe_nim_version)
+
+
+def ensure_nimpy() -> str:
     """
     Makes sure that the Nimpy Nim library is installed.
 
     Verifies that the [Nimpy Library](https://github.com/yglukhov/nimpy) is
-    installed and installs it otherwise.
+    installed and installs it otherwise. The location of Nimpy is cached with
+    the toolchain probes so Nimble is only queried when the toolchain changes.
+
+    Returns:
+        The folder Nimpy is installed in.
 
     NOTE: Nimporter would not be possible without Nimpy. Thank you
     Yuriy Glukhov for making this project possible!
     """
     ic()
 
-    show_output = 'NIMPORTER_INSTRUMENT' in os.environ
-    code, *_ = run_process(shlex.split('nimble path nimpy'), show_output)
+    def probe_nimpy_path() -> str:
+        code, out, _ = run_process(shlex.split('nimble path nimpy'))
 
-    if code != 0:
-        ic()
-        nimble_args = shlex.split('nimble install nimpy --accept')
-        code, _, stderr = run_process(nimble_args, show_output)
+        if code != 0:
+            ic()
+            show_output = 'NIMPORTER_INSTRUMENT' in os.environ
+            nimble_args = shlex.split('nimble install nimpy --accept')
+            code, _, stderr = run_process(nimble_args, show_output)
 
-        if code:
-            raise CompilationFailedException(stderr)
-    return
+            if code:
+                raise CompilationFailedException(stderr)
+
+            code, out, _ = run_process(shlex.split('nimble path nimpy'))
+
+        return out.strip() # type: ignore[return-value]
+
+    with span('ensure_nimpy'):
+        return probe_toolchain('nimpy_path', probe_nimpy_path) or ''
+
+
+def get_nimpy_version() -> Optional[str]:
+    """
+    Returns the name of the folder Nimble installed Nimpy in, such as
+    `nimpy-0.2.0`, which identifies its version. None if Nimpy is not
+    available.
+    """
+    try:
+        return Path(ensure_nimpy()).name or None
+    except (OSError, NimporterException):
+        return None
+
+
+def get_module_path_args(path: Path) -> List[str]:
+    """
+    Extension modules are compiled from a copy in a temporary folder. Adds
+    the folder of the original module to Nim's search path so that it can
+    still import the Nim modules next to it.
+    """
+    if path.is_dir():
+        return []
+    return [f'--path:{path.resolve().absolute().parent}']
 
 
 class NimporterException(Exception):
@@ -231,6 +586,7 @@ class NimporterException(Exception):
 
 class CompilationFailedException(NimporterException):
     def __init__(self, stderr: Union[bytes, str]) -> None:
+        self.stderr = stderr
         super().__init__(
             f'Nim Compilation Failed. Rerun with NIMPORTER_INSTRUMENT for'
             f' full Nim output: {stderr}' # type: ignore[str-bytes-safe]
@@ -243,6 +599,362 @@ class ImportFailedException(NimporterException):
     pass
 
 
+class CompilationDisabledException(NimporterException):
+    "Raised instead of compiling an extension when Nimporter is frozen."
+    def __init__(self, module_path: Path) -> None:
+        super().__init__(
+            f'Nimporter is frozen (NIMPORTER_FROZEN) and {module_path} is not '
+            'in its manifest. Run `nimporter freeze` again to add it.'
+        )
+
+
+# Memoizes the `[tool.nimporter]` table of each pyproject.toml along with its
+# modification time so that it is only parsed again when it changes.
+_PROJECT_CONFIGS: Dict[Path, Tuple[int, Dict[str, Any]]] = {}
+
+
+def find_project_config(path: Path) -> Tuple[Optional[Path], Dict[str, Any]]:
+    """
+    Finds the nearest pyproject.toml above an extension.
+
+    Args:
+        path(Path): the absolute path of the extension.
+
+    Returns:
+        The folder containing the pyproject.toml (or None if there is none)
+        and its `[tool.nimporter]` table.
+    """
+    for folder in path.parents:
+        pyproject = folder / 'pyproject.toml'
+
+        try:
+            mtime = pyproject.stat().st_mtime_ns
+        except OSError:
+            continue
+
+        cached = _PROJECT_CONFIGS.get(pyproject)
+
+        if cached and cached[0] == mtime:
+            return folder, cached[1]
+
+        if sys.version_info >= (3, 11):
+            import tomllib
+        else:
+            import tomli as tomllib
+
+        with pyproject.open('rb') as file:
+            config = tomllib.load(file).get('tool', {}).get('nimporter', {})
+
+        _PROJECT_CONFIGS[pyproject] = mtime, config
+        return folder, config
+
+    return None, {}
+
+
+def get_build_profile(path: Path, profile: Optional[str] = None) -> str:
+    """
+    Selects the build profile of an extension.
+
+    In order of precedence, the profile is the one given, the one named by
+    `NIMPORTER_PROFILE`, the `profile` of the extension in the
+    `[tool.nimporter.extensions."<import path>"]` table of the nearest
+    pyproject.toml, the `profile` in `[tool.nimporter]` or `debug`.
+
+    Args:
+        path(Path): the absolute path of the extension.
+        profile(str): overrides the profile of every extension.
+
+    Returns:
+        The name of the build profile.
+    """
+    profile = profile or os.environ.get('NIMPORTER_PROFILE')
+
+    if profile:
+        return profile
+
+    project, config = find_project_config(path)
+
+    if project:
+        relative_path = path.relative_to(project)
+
+        if relative_path.suffix == '.nim':
+            relative_path = relative_path.with_suffix('')
+
+        parts = relative_path.parts
+        matches = []
+
+        # Extensions are named by the trailing components of their import
+        # path (so "pkg.mod" is found in "src/pkg/mod.nim" but "mod" does not
+        # name "pkg/other_mod.nim") and the most specific name wins
+        for name, options in config.get('extensions', {}).items():
+            name_parts = tuple(name.split('.'))
+
+            if parts[-len(name_parts):] == name_parts and 'profile' in options:
+                matches.append((len(name_parts), options['profile']))
+
+        if matches:
+            return max(matches)[1]
+
+    return config.get('profile', DEFAULT_BUILD_PROFILE)
+
+
+def get_profile_args(path: Path, profile: Optional[str] = None) -> List[str]:
+    """
+    Converts the build profile of an extension into Nim CLI arguments.
+
+    Args:
+        path(Path): the absolute path of the extension.
+        profile(str): overrides the profile of every extension.
+
+    Returns:
+        The Nim CLI arguments of the profile.
+    """
+    name: Optional[str] = get_build_profile(path, profile)
+    profiles = {**BUILD_PROFILES, **find_project_config(path)[1].get('profiles', {})}
+    chain: List[str] = []
+
+    # Profiles can inherit the options of another profile
+    while name:
+        if name in chain or name not in profiles:
+            raise NimporterException(
+                f'Unknown or circular build profile "{name}" for {path}. '
+                f'Available profiles: {", ".join(profiles)}'
+            )
+
+        chain.append(name)
+        name = profiles[name].get('inherits')
+
+    options: Dict[str, Any] = {}
+    args: List[str] = []
+
+    for name in reversed(chain):
+        options.update(profiles[name])
+        args.extend(profiles[name].get('args', []))
+
+    if 'opt' in options:
+        args.append(f'--opt:{options["opt"]}')
+
+    if 'mm' in options:
+        args.append(f'--mm:{options["mm"]}')
+
+    if 'stack_trace' in options:
+        args.append(f'--stackTrace:{"on" if options["stack_trace"] else "off"}')
+
+    if 'line_trace' in options:
+        args.append(f'--lineTrace:{"on" if options["line_trace"] else "off"}')
+
+    if options.get('lto'):
+        args.extend(['--passC:-flto', '--passL:-flto'])
+
+    return args
+
+
+def get_cpu_flags() -> FrozenSet[str]:
+    "Returns the instruction set extensions supported by the host CPU."
+    def probe_cpu_flags() -> str:
+        import cpuinfo  # Calling get_cpu_info() is expensive
+        return ' '.join(sorted(cpuinfo.get_cpu_info().get('flags', [])))
+
+    flags = probe_toolchain('cpu_flags', probe_cpu_flags, host_only=True)
+    return frozenset((flags or '').split())
+
+
+def get_cpu_variants(path: Path) -> List[str]:
+    """
+    Returns the CPU variants an extension is built for besides its baseline
+    build, best first. Building CPU variants is opt-in using
+    `NIMPORTER_CPU_VARIANTS` (comma separated) or `cpu_variants` in the
+    `[tool.nimporter]` table of the nearest pyproject.toml.
+
+    Variants are only built for x86-64 hosts using GCC or Clang.
+
+    Args:
+        path(Path): the absolute path of the extension.
+    """
+    if 'NIMPORTER_CPU_VARIANTS' in os.environ:
+        variants = [
+            variant.strip()
+            for variant in os.environ['NIMPORTER_CPU_VARIANTS'].split(',')
+            if variant.strip()
+        ]
+    else:
+        variants = find_project_config(path)[1].get('cpu_variants', [])
+
+    if not variants:
+        return []
+
+    for variant in variants:
+        if variant not in CPU_VARIANTS:
+            raise NimporterException(
+                f'Unknown CPU variant "{variant}" for {path}. Available CPU '
+                f'variants: {", ".join(CPU_VARIANTS)}'
+            )
+
+    _, arch, cc = get_host_info()
+
+    if arch != 'x86_64' or cc not in ('gcc', 'clang'):
+        ic('CPU variants are not supported on', arch, cc)
+        return []
+
+    # Order from most to least specialized regardless of configuration order
+    return [
+        variant for variant in reversed(list(CPU_VARIANTS))
+        if variant in variants
+    ]
+
+
+def is_cpu_variant_supported(variant: str) -> bool:
+    "Whether the host CPU can run an extension built for a CPU variant."
+    return CPU_VARIANTS[variant] <= get_cpu_flags()
+
+
+def get_cpu_variant_tag(variant: str) -> str:
+    """
+    Returns the name that distinguishes the files of a CPU variant. Native
+    builds are tagged with the CPU flags they were built for so that a
+    `__pycache__` shared between machines never runs them on another CPU.
+    """
+    if variant != 'native':
+        return variant
+
+    digest = hashlib.sha256(' '.join(sorted(get_cpu_flags())).encode())
+    return f'native-{digest.hexdigest()[:8]}'
+
+
+# Compiled hash patterns, keyed by the patterns
+_HASH_PATTERNS: Dict[Tuple[str, ...], Pattern[str]] = {}
+
+
+def compile_patterns(patterns: Iterable[str]) -> Pattern[str]:
+    "Compiles glob patterns into one regular expression matching file names."
+    key = tuple(patterns)
+
+    if key not in _HASH_PATTERNS:
+        import re
+        _HASH_PATTERNS[key] = re.compile(
+            '|'.join(fnmatch.translate(pattern) for pattern in key) or '(?!)'
+        )
+
+    return _HASH_PATTERNS[key]
+
+
+def get_hash_patterns(path: Path) -> Tuple[Pattern[str], Pattern[str]]:
+    """
+    Returns which files of an extension library are hashed to tell whether it
+    changed: `hash_include` and `hash_ignore` in the `[tool.nimporter]` table
+    of the nearest pyproject.toml, or the defaults.
+
+    Returns:
+        The patterns of file names to include and the patterns of file and
+        folder names to ignore.
+    """
+    config = find_project_config(path.absolute())[1]
+    return (
+        compile_patterns(config.get('hash_include', DEFAULT_HASH_INCLUDE)),
+        compile_patterns(config.get('hash_ignore', DEFAULT_HASH_IGNORE)),
+    )
+
+
+def iterate_extension_files(module_path: Path) -> Iterator[Path]:
+    """
+    Yields every file belonging to an extension module or extension library.
+
+    Only the files of a library matching its hash patterns are yielded, in a
+    stable order, so that version control folders, nimcaches and data files
+    are never hashed.
+    """
+    if module_path.is_file():
+        yield module_path
+        return
+
+    include, ignore = get_hash_patterns(module_path)
+
+    def walk(folder: str) -> Iterator[Path]:
+        try:
+            entries = sorted(os.scandir(folder), key=lambda entry: entry.name)
+        except OSError:
+            return
+
+        for entry in entries:
+            if ignore.match(entry.name):
+                continue
+
+            if entry.is_dir():
+                yield from walk(entry.path)
+
+            elif include.match(entry.name):
+                yield Path(entry.path)
+
+    yield from walk(str(module_path))
+
+
+def hash_file(path: Path) -> bytes:
+    """
+    Hashes the contents of a file one block at a time so that memory use does
+    not grow with the size of the file.
+
+    Returns:
+        The digest of the contents or a marker if the file cannot be read.
+    """
+    digest = hashlib.sha256()
+
+    try:
+        with open(path, 'rb', buffering=0) as file:
+            block = file.read(HASH_BLOCK_SIZE)
+
+            while block:
+                digest.update(block)
+                block = file.read(HASH_BLOCK_SIZE)
+    except OSError:
+        return b'\0missing'
+
+    return digest.digest()
+
+
+def hash_contents(paths: List[Path]) -> List[bytes]:
+    """
+    Hashes the contents of files.
+
+    Hashlib releases the GIL while hashing so large amounts of data are hashed
+    on a thread pool. Small files are faster to hash one at a time.
+    """
+    size = 0
+
+    if len(paths) > 1:
+        for path in paths:
+            try:
+                size += os.stat(path).st_size
+            except OSError:
+                "Missing files are hashed as such"
+
+    if size < PARALLEL_HASH_MIN_SIZE:
+        return [hash_file(path) for path in paths]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = min(len(paths), os.cpu_count() or 1, 16)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(hash_file, paths))
+
+
+def hash_named_files(files: Iterable[Tuple[str, bytes]]) -> bytes:
+    """
+    Combines the names of files with the digests of their contents.
+
+    Args:
+        files(iterable): the name and digest of each file, in order.
+    """
+    digest = hashlib.sha256()
+
+    for name, file_digest in files:
+        digest.update(name.encode())
+        digest.update(b'\0')
+        digest.update(file_digest)
+
+    return digest.digest()
+
+
 def hash_extension(module_path: Path) -> bytes:
     """
     Convenience function to hash an extension module or extension library.
@@ -253,36 +965,126 @@ def hash_extension(module_path: Path) -> bytes:
     Returns:
         The hash bytes of the Nim file.
     """
-    digest = hashlib.sha256()
-
     if module_path.is_file():
-        block_size = 65536
+        digest = hash_file(module_path)
 
-        with module_path.open('rb') as file:
-            buf = file.read(block_size)
+    else:
+        # Paths relative to the library in the same form on every platform so
+        # the hash does not depend on the working directory or checkout path
+        files = list(iterate_extension_files(module_path))
+        digest = hash_named_files(zip(
+            (item.relative_to(module_path).as_posix() for item in files),
+            hash_contents(files)
+        ))
 
-            while len(buf) > 0:
-                digest.update(buf)
-                buf = file.read(block_size)
+    ic(digest.hex())
 
-    else:
-        def walk_folder(path: Path) -> Iterator[Path]:
-            for item in path.iterdir():
-                if item.is_dir():
-                    if item.stem == '__pycache__':
-                        continue
-                    for i in walk_folder(item):
-                        yield i
-                else:
-                    yield item
-
-        for item in walk_folder(module_path):
-            digest.update(str(item).encode())
-            digest.update(item.read_bytes())
-
-    ic(digest.hexdigest())
+    return digest
 
-    return digest.digest()
+
+def fingerprint_extension(module_path: Path) -> Fingerprint:
+    """
+    Identifies the current state of an extension's files using `stat()` alone.
+
+    Args:
+        module_path(Path): the extension module or extension library.
+
+    Returns:
+        The path (relative to the extension), size, modification time and
+        inode of each file of the extension.
+    """
+    root = module_path if module_path.is_dir() else module_path.parent
+    return fingerprint_files(iterate_extension_files(module_path), root)
+
+
+def fingerprint_files(
+    files: Iterable[Path],
+    root: Optional[Path] = None
+) -> Fingerprint:
+    """
+    Identifies the current state of files using `stat()` alone.
+
+    Args:
+        files(iterable): the files to fingerprint.
+        root(Path): the paths in the fingerprint are made relative to this.
+
+    Returns:
+        The path, size, modification time and inode of each file. Missing
+        files are recorded with a size, modification time and inode of -1.
+    """
+    fingerprint = []
+
+    for item in files:
+        name = (item.relative_to(root) if root else item).as_posix()
+
+        try:
+            stat = item.stat()
+            fingerprint.append((
+                name, stat.st_size, stat.st_mtime_ns, stat.st_ino
+            ))
+        except OSError:
+            fingerprint.append((name, -1, -1, -1))
+
+    return fingerprint
+
+
+def hash_files(files: Iterable[Path]) -> bytes:
+    """
+    Hashes the contents of files spread across the file system, such as the
+    dependencies of an extension.
+
+    Files are identified by their name alone (and sorted by it) rather than by
+    their path, so that the hash is the same wherever the checkout, Nim and
+    Nimble packages are installed.
+    """
+    files = list(files)
+    return hash_named_files(sorted(zip(
+        (item.name for item in files), hash_contents(files)
+    )))
+
+
+def is_fingerprint_racy(fingerprint: Fingerprint) -> bool:
+    """
+    A file modified within the timestamp granularity of the file system could
+    be modified again without its modification time changing. These recently
+    modified files cannot be trusted to be unchanged based on `stat()` alone.
+    """
+    recently = time.time_ns() - 2_000_000_000
+    return any(mtime_ns >= recently for _, _, mtime_ns, _ in fingerprint)
+
+
+# Memoizes the hash of each extension for the lifetime of the interpreter so
+# that unchanged extensions are only ever hashed once per process.
+_EXTENSION_HASHES: Dict[str, Tuple[Fingerprint, bytes]] = {}
+
+
+def get_extension_hash(module_path: Path) -> Tuple[Fingerprint, bytes]:
+    """
+    Returns the fingerprint and hash of an extension.
+
+    The contents of the extension are only hashed if its fingerprint changed
+    since it was last hashed by this interpreter.
+
+    Args:
+        module_path(Path): the extension module or extension library.
+
+    Returns:
+        The fingerprint and the hash bytes of the extension.
+    """
+    key = str(module_path.absolute())
+    fingerprint = fingerprint_extension(module_path)
+    memoized = _EXTENSION_HASHES.get(key)
+
+    if memoized and memoized[0] == fingerprint:
+        return memoized
+
+    with span('hash', path=module_path, files=len(fingerprint)):
+        digest = hash_extension(module_path)
+
+    if not is_fingerprint_racy(fingerprint):
+        _EXTENSION_HASHES[key] = fingerprint, digest
+
+    return fingerprint, digest
 
 
 class ExtLib:
@@ -318,15 +1120,41 @@ class ExtLib:
             self.full_path = path.resolve().absolute()
 
         self.pycache = self.full_path.parent / '__pycache__'
+        self.root = root.resolve().absolute()
 
         self.import_namespace = get_import_path(self.relative_path, root)
         self.hash_filename = self.pycache / f'{self.symbol}.hash'
+        self.fingerprint_filename = self.pycache / f'{self.symbol}.stat'
+        self.dependencies_filename = self.pycache / f'{self.symbol}.deps'
+        self.lock_filename = self.pycache / f'{self.symbol}.lock'
         self.build_artifact = (
             self.pycache / f'{self.symbol}{PYTHON_LIB_EXT}'
         )
+        self.cpu_variant: Optional[str] = None
+        self.cpu_args: List[str] = []
         return
 
+    def with_cpu_variant(self, variant: str) -> 'ExtLib':
+        """
+        Returns the same extension but built for a CPU variant. Each variant
+        has its own build artifact and hash files within `__pycache__`.
+        """
+        ext = copy.copy(self)
+        tag = get_cpu_variant_tag(variant)
+        ext.cpu_variant = variant
+        ext.cpu_args = [f'--passC:-march={variant}']
+        ext.hash_filename = self.pycache / f'{self.symbol}.{tag}.hash'
+        ext.fingerprint_filename = self.pycache / f'{self.symbol}.{tag}.stat'
+        ext.dependencies_filename = self.pycache / f'{self.symbol}.{tag}.deps'
+        ext.lock_filename = self.pycache / f'{self.symbol}.{tag}.lock'
+        ext.build_artifact = (
+            self.pycache / f'{self.symbol}.{tag}{PYTHON_LIB_EXT}'
+        )
+        return ext
+
     def __str__(self) -> str:
+        if self.cpu_variant:
+            return f'<ExtLib {self.import_namespace} [{self.cpu_variant}]>'
         return f'<ExtLib {self.import_namespace}>'
 
     def __repr__(self) -> str:
@@ -334,3 +1162,13 @@ class ExtLib:
 
     def __format__(self, *args, **kwargs) -> str: # type: ignore[no-untyped-def]
         return str(self)
+
+
+def get_ext_lib(extension_path: Path, root: Path) -> ExtLib:
+    "Wraps a path returned by `find_extensions()` in an ExtLib."
+    library = extension_path.is_dir()
+    module_path = (
+        extension_path / f'{extension_path.name}.nim' if library
+        else extension_path
+    )
+    return ExtLib(module_path, root, library)
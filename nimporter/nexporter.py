@@ -1,36 +1,88 @@
 import os
 import sys
+import json
+import tempfile
+import threading
 from typing import *
 from pathlib import Path
-from icecream import ic
+from nimporter.instrument import ic
 from nimporter.lib import *
+from nimporter.cache import install_file
 from distutils.extension import Extension
+from setuptools.command.build_ext import build_ext
 import shlex
 import shutil
 import subprocess
 
+# Generated C files are stored once in this folder of `nim-extensions`, named
+# after the digest of their contents. It can't be mistaken for an extension
+# since it is not a valid import path.
+SOURCES_DIR: str = 'c-sources'
+
+
+def iterate_target_manifests(root: Path) -> Iterator[Tuple[str, Path]]:
+    "Yields the import path and manifest of every bundled extension target."
+    for extension_root in sorted((root / EXT_DIR).iterdir()):
+        if extension_root.name == SOURCES_DIR or not extension_root.is_dir():
+            continue
+
+        for manifest in sorted(extension_root.glob('*.json')):
+            yield extension_root.name, manifest
+
+
+def read_target_manifest(manifest: Path) -> Dict[str, Path]:
+    """
+    Returns the file name and content-addressed location of each file of the
+    generated C code of an extension target.
+    """
+    ext_dir = manifest.parent.parent
+    files = json.loads(manifest.read_text())['files']
+    return {name: ext_dir / location for name, location in files.items()}
+
+
+def materialize_target(manifest: Path) -> Path:
+    """
+    Recreates the folder of C files of an extension target, using their
+    original names, from the content-addressed files its manifest references.
+
+    Returns:
+        The folder containing the C files and headers of the target.
+    """
+    out_dir = manifest.with_suffix('')
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    for name, source in read_target_manifest(manifest).items():
+        install_file(source, out_dir / name)
+
+    return out_dir
+
 
 def get_host_extension_bundle(root: Path) -> List[Extension]:
     extensions = []
     ext_dir = root / EXT_DIR
+    platform, arch, cc = get_host_info()
+    host_info = f'{platform}-{arch}-{cc}'
+
+    for extension_root in sorted(ext_dir.iterdir()):
+        if extension_root.name == SOURCES_DIR or not extension_root.is_dir():
+            continue
 
-    for extension_root in ext_dir.iterdir():
-        platform, arch, cc = get_host_info()
-        host_info = f'{platform}-{arch}-{cc}'
-        host_extension = extension_root / host_info
+        manifest = extension_root / f'{host_info}.json'
 
-        ic(host_extension)
+        ic(manifest)
 
-        assert host_extension.exists(), (
+        assert manifest.exists(), (
             f'No extension found for host platform/arch: {host_info}.\n'
-            f'Bundled extensions: {[i.name for i in ext_dir.iterdir()]}\n'
+            f'Bundled extensions: {[i.name for i in extension_root.iterdir()]}\n'
             f'Perhaps run "nimporter clean"?'
         )
 
+        host_extension = materialize_target(manifest)
+
         extensions.append(
             Extension(
                 name=extension_root.name,
-                sources=[str(c) for c in host_extension.glob('*.c')],
+                sources=[str(c) for c in sorted(host_extension.glob('*.c'))],
                 include_dirs=[str(host_extension)],
             )
         )
@@ -43,6 +95,10 @@ def get_sdist_extension_bundle(root: Path) -> List[Extension]:
     The goal of this function is to get every combination of platform,
     architecture, and compiler as it's own extension. The reason why is to make
     packaging into source distributions easier.
+
+    Each target only lists its manifest and the content-addressed files it
+    references. Files shared between targets and extensions are only included
+    once in the source distribution.
     """
 
     # ! In this case, the extension's name does not matter (which is why the)
@@ -53,20 +109,17 @@ def get_sdist_extension_bundle(root: Path) -> List[Extension]:
     # ! for the host platform.
     extensions = []
 
-    for extension_root in (root / EXT_DIR).iterdir():
-        for extension_per_target in extension_root.iterdir():
-            all_files = [
-                str(c) for c in extension_per_target.iterdir()
-                if not c.suffix == '.json'
-            ]
+    for import_path, manifest in iterate_target_manifests(root):
+        sources = sorted({
+            str(source) for source in read_target_manifest(manifest).values()
+        })
 
-            extensions.append(
-                Extension(
-                    name=f'{extension_root.name}-{extension_per_target.name}',
-                    sources=all_files,
-                    include_dirs=[str(extension_per_target)]
-                )
+        extensions.append(
+            Extension(
+                name=f'{import_path}-{manifest.stem}',
+                sources=[str(manifest)] + sources,
             )
+        )
 
     return ic(extensions)
 
@@ -80,30 +133,36 @@ def find_nim_std_lib() -> Optional[Path]:
     it can even find the stdlib of the currently selected toolchain when
     using Choosenim.
 
+    The result is cached with the other toolchain probes so that Nim and
+    Choosenim are only queried again when the toolchain changes.
+
     Returns:
         The Path to the Nim stdlib 'lib' directory if it exists and None
         otherwise.
     """
+    def probe_nim_std_lib() -> Optional[str]:
+        stdlib = search_nim_std_lib()
+        return str(stdlib) if stdlib else None
+
+    stdlib = probe_toolchain('nim_stdlib', probe_nim_std_lib)
+    return Path(stdlib) if stdlib else None
+
+
+def search_nim_std_lib() -> Optional[Path]:
+    "Searches for Nim's stdlib. Use the cached `find_nim_std_lib()` instead."
     # If Nim is not installed there's nothing to be done
-    if not shutil.which('nim'):
+    nimexe = shutil.which('nim')
+    if not nimexe:
         return # type: ignore[return-value]
 
     # Installed via choosenim_install Pypi package
     choosenim_dir = Path('~/.choosenim/toolchains').expanduser().absolute()
-    if choosenim_dir.exists: # type: ignore[truthy-function]
-        try:
-            nim_ver = (subprocess.check_output(['nim', '-v'])
-                .decode(errors='ignore')
-                .splitlines()[0]
-            )
-
-            version_string = nim_ver.split()[3]
-            stdlib = choosenim_dir / f'nim-{version_string}/lib'
+    version_string = get_nim_version()
+    if choosenim_dir.exists() and version_string:
+        stdlib = choosenim_dir / f'nim-{version_string}/lib'
 
-            if (stdlib / 'system.nim').exists():
-                return stdlib.resolve().absolute()
-        except:
-            "Keep trying other methods"
+        if (stdlib / 'system.nim').exists():
+            return stdlib.resolve().absolute()
 
     # Installed via ChooseNim
     if shutil.which('choosenim'):
@@ -119,10 +178,9 @@ def find_nim_std_lib() -> Optional[Path]:
             return stdlib.resolve().absolute()
 
     # Installed manually
-    nimexe: Path = Path(nimexe)
-    result = nimexe.parent / '../lib'
+    result = Path(nimexe).parent / '../lib'
     if not (result / 'system.nim').exists():
-        result = nimexe.resolve().parent / '../lib'
+        result = Path(nimexe).resolve().parent / '../lib'
 
         if not (result / 'system.nim').exists():
             return None
@@ -130,6 +188,43 @@ def find_nim_std_lib() -> Optional[Path]:
     return result.resolve().absolute()
 
 
+def store_target(out_dir: Path, ext_dir: Path, manifest: Path) -> int:
+    """
+    Moves the generated C code of an extension target into the
+    content-addressed sources of the bundle and writes its manifest.
+
+    Every file is stored under the SHA-256 digest of its contents so identical
+    files (such as `nimbase.h` or the C code of Nimpy and the Nim runtime) are
+    only stored once no matter how many extensions and targets use them.
+
+    Args:
+        out_dir(Path): the folder the C code was generated into.
+        ext_dir(Path): the `nim-extensions` folder of the project.
+        manifest(Path): where to write the manifest of the target.
+
+    Returns:
+        The number of files that were not already stored.
+    """
+    files = {}
+    stored = 0
+
+    for item in sorted(out_dir.iterdir()):
+        # Nim's build instructions are not needed to compile the C code
+        if not item.is_file() or item.suffix == '.json':
+            continue
+
+        digest = hash_file(item).hex()
+        location = Path(SOURCES_DIR) / digest[:2] / f'{digest}{item.suffix}'
+        files[item.name] = location.as_posix()
+
+        if not (ext_dir / location).exists():
+            install_file(item, ext_dir / location)
+            stored += 1
+
+    write_atomically(manifest, json.dumps(dict(files=files), indent=4).encode())
+    return stored
+
+
 def copy_headers(build_dir_relative: Path) -> Path:
     "Can't compile without nimbase.h"
     NIMBASE = 'nimbase.h'
@@ -152,7 +247,9 @@ def is_run_from_python_setup_py_sdist() -> bool:
 
 def get_nim_extensions(
     platforms: List[str],
-    root: Optional[Path] = None
+    root: Optional[Path] = None,
+    jobs: Optional[int] = None,
+    profile: Optional[str] = None
 ) -> List[Extension]:
     """
     Auto-discovers all Nim extensions in the project and returns them.
@@ -177,22 +274,130 @@ def get_nim_extensions(
         For each of the auto-discovered extensions:
             Find exactly 1 that matches the platform-arch combo
             Return that one extension
+
+    Generating C code is done concurrently using `jobs` Nim processes which
+    defaults to the `NIMPORTER_JOBS` environment variable or the CPU count.
+
+    The C code is generated using the same build profile as importing the
+    extensions would use unless `profile` is given.
     """
     root = root or Path()
 
     if is_run_from_python_setup_py_sdist():
         if not (root / EXT_DIR).exists():
             ic(f'Compiling for platforms: {platforms}')
-            compile_extensions_to_c(platforms, root)
+            compile_extensions_to_c(platforms, root, jobs, profile)
         return ic(get_sdist_extension_bundle(root))
 
     else:
         if not (root / EXT_DIR).exists():
             ic('Compiling for host platform only')
-            compile_extensions_to_c([get_host_info()[0]], root)
+            compile_extensions_to_c([get_host_info()[0]], root, jobs, profile)
         return ic(get_host_extension_bundle(root))
 
 
+def compile_in_parallel(compiler: Any, jobs: int) -> Callable[..., List[str]]:
+    """
+    Returns a replacement for `compiler.compile()` that compiles each source
+    file on its own thread.
+
+    This is the same as `CCompiler.compile()` except for the loop. At most
+    `jobs` C compiler processes run at once, even when several extensions are
+    compiled at the same time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    slots = threading.BoundedSemaphore(jobs)
+
+    def compile(
+        sources: List[str],
+        output_dir: Optional[str] = None,
+        macros: Optional[List[Any]] = None,
+        include_dirs: Optional[List[str]] = None,
+        debug: int = 0,
+        extra_preargs: Optional[List[str]] = None,
+        extra_postargs: Optional[List[str]] = None,
+        depends: Optional[List[str]] = None,
+    ) -> List[str]:
+        macros, objects, extra_postargs, pp_opts, build = (
+            compiler._setup_compile(
+                output_dir, macros, include_dirs, sources, depends,
+                extra_postargs
+            )
+        )
+        cc_args = compiler._get_cc_args(pp_opts, debug, extra_preargs)
+
+        def compile_object(obj: str) -> None:
+            src, ext = build[obj]
+
+            with slots:
+                compiler._compile(
+                    obj, src, ext, cc_args, extra_postargs, pp_opts
+                )
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(compile_object, obj)
+                for obj in objects
+                if obj in build
+            ]
+
+            # Raise the first failure once every other file is compiled
+            for future in futures:
+                future.result()
+
+        # Return *all* object filenames, not just the ones that were built
+        return objects
+
+    return compile
+
+
+# Setuptools has no type hints (with the supported versions) so `build_ext`
+# is `Any` to Mypy
+class ParallelBuildExt(build_ext): # type: ignore[misc]
+    """
+    The `build_ext` command, but extensions and the C files within each of
+    them are compiled concurrently.
+
+    The C code generated by Nim for a single extension spans dozens of files
+    that `build_ext` would otherwise compile one at a time. Use it in
+    `setup.py` alongside `get_nim_extensions()`:
+
+        setup(
+            ...,
+            ext_modules=get_nim_extensions(platforms=[WINDOWS, LINUX, MACOS]),
+            cmdclass={'build_ext': ParallelBuildExt},
+        )
+
+    The number of C compiler processes to run at once is given with
+    `--parallel`/`-j` and defaults to the `NIMPORTER_JOBS` environment
+    variable or the CPU count. MSVC compiles the files of an extension one at
+    a time since its compiler class does not support compiling them
+    separately, though extensions are still built concurrently.
+    """
+    # Given by the user (an int, or True when not given a number) until
+    # `finalize_options()` which leaves the job count in `jobs` too
+    parallel: Union[bool, int, None]
+    jobs: int
+
+    def finalize_options(self) -> None:
+        super().finalize_options()
+        self.jobs = get_job_count(
+            None if self.parallel is True else self.parallel
+        )
+
+        # Also makes `build_ext` build the extensions themselves concurrently
+        self.parallel = self.jobs
+
+    def build_extensions(self) -> None:
+        if self.jobs > 1 and self.compiler.compiler_type != 'msvc':
+            self.compiler.compile = compile_in_parallel(
+                self.compiler, self.jobs
+            )
+
+        super().build_extensions()
+
+
 def iterate_target_triples(
     platforms: List[str]
 ) -> Iterator[Tuple[str, str, str]]:
@@ -206,54 +411,154 @@ def iterate_target_triples(
                 yield platform, arch, compiler
 
 
-def compile_extensions_to_c(platforms: List[str], root: Path) -> None:
-    "Compile all extensions to C for bundling starting at a given path."
+def compile_extensions_to_c(
+    platforms: List[str],
+    root: Path,
+    jobs: Optional[int] = None,
+    profile: Optional[str] = None
+) -> None:
+    """
+    Compile all extensions to C for bundling starting at a given path.
+
+    Every extension/target pair is compiled by its own Nim process on a pool
+    of `jobs` workers and writes to its own output directory. The targets of
+    a library are compiled one after another since Nimble runs within the
+    folder of the library. A failing target does not stop the others so their
+    generated C is kept, and every failing target is reported at the end.
+
+    Args:
+        platforms(list): the platforms to generate C for.
+        root(Path): the project root to search for extensions.
+        jobs(int): how many Nim processes to run at once. Defaults to
+            `get_job_count()`.
+        profile(str): the build profile to use instead of the configured one.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
     ensure_nimpy()
 
+    ext_dir = (root / EXT_DIR).absolute()
+    ext_dir.mkdir(parents=True, exist_ok=True)
+
+    triples = list(iterate_target_triples(platforms))
+    tasks = []
+
     for extension_path in ic(find_extensions(root)):
-        ext_dir = (root / EXT_DIR).absolute()
-        ext_dir.mkdir(parents=True, exist_ok=True)
+        if extension_path.is_dir():
+            tasks.append((extension_path, triples))
+        else:
+            tasks.extend((extension_path, [triple]) for triple in triples)
+
+    failures: List[str] = []
+
+    with ThreadPoolExecutor(max_workers=get_job_count(jobs)) as pool:
+        futures = [
+            pool.submit(
+                compile_targets_to_c,
+                extension_path,
+                root,
+                ext_dir,
+                task_triples,
+                profile
+            )
+            for extension_path, task_triples in tasks
+        ]
 
-        with convert_to_lib_if_needed(extension_path) as compilation_dir:
-            nim_module = compilation_dir / (extension_path.stem + '.nim')
-            import_path = get_import_path(extension_path, root)
+        for future in as_completed(futures):
+            failures.extend(future.result())
 
-            with cd(compilation_dir) as tmp_cwd:
-                for platform, arch, cc in iterate_target_triples(platforms):
-                    nim_platform = PLATFORM_TABLE[platform]
-                    nim_arch = ARCH_TABLE[arch]
-                    target = f'{platform}-{arch}-{cc}'
+    if failures:
+        raise CompilationFailedException('\n\n'.join(failures))
+    return
 
-                    ic(f'Compiling {import_path} for {target}')
 
-                    out_dir = ext_dir / import_path / target
-                    out_dir.mkdir(parents=True, exist_ok=True)
+def compile_targets_to_c(
+    extension_path: Path,
+    root: Path,
+    ext_dir: Path,
+    triples: List[Tuple[str, str, str]],
+    profile: Optional[str] = None
+) -> List[str]:
+    """
+    Compile one extension to C for each of the given targets in turn.
 
-                    # Needed during compilation of the Nim extension on the
-                    # client's machine that will not have Nim installed
-                    copy_headers(out_dir)
+    Returns:
+        A description of each target that failed to compile.
+    """
+    failures = []
 
-                    cli_args = ALWAYS_ARGS + [
-                        '--compileOnly',
-                        f'--nimcache:{out_dir}',
-                        f'--os:{nim_platform}',
-                        f'--cpu:{nim_arch}',
-                        f'--cc:{cc}',
-                        nim_module.name
-                    ]
+    for triple in triples:
+        try:
+            compile_extension_to_c(extension_path, root, ext_dir, triple, profile)
+        except Exception as error:
+            reason = (
+                error.stderr if isinstance(error, CompilationFailedException)
+                else f'{type(error).__name__}: {error}'
+            )
 
-                    ic(cli_args)
+            if isinstance(reason, bytes):
+                reason = reason.decode(errors='ignore')
 
-                    code, _, stderr = run_process(
-                        cli_args,
-                        'NIMPORTER_INSTRUMENT' in os.environ
-                    )
+            import_path = get_import_path(extension_path, root)
+            target = '-'.join(triple)
+            failures.append(f'{import_path} for {target}:\n{reason}')
+
+    return failures
+
+
+def compile_extension_to_c(
+    extension_path: Path,
+    root: Path,
+    ext_dir: Path,
+    triple: Tuple[str, str, str],
+    profile: Optional[str] = None
+) -> None:
+    "Compile one extension to C for one platform/architecture/compiler."
+    platform, arch, cc = triple
+    nim_platform = PLATFORM_TABLE[platform]
+    nim_arch = ARCH_TABLE[arch]
+    target = f'{platform}-{arch}-{cc}'
+    import_path = get_import_path(extension_path, root)
+
+    ic(f'Compiling {import_path} for {target}')
+
+    manifest = ext_dir / import_path / f'{target}.json'
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            convert_to_lib_if_needed(extension_path) as compilation_dir:
+        out_dir = Path(tmp_dir)
+
+        # Needed during compilation of the Nim extension on the client's
+        # machine that will not have Nim installed
+        copy_headers(out_dir)
+
+        nim_module = compilation_dir / (extension_path.stem + '.nim')
+
+        cli_args = ALWAYS_ARGS + get_profile_args(
+            extension_path.resolve().absolute(), profile
+        ) + get_module_path_args(extension_path) + [
+            '--compileOnly',
+            f'--nimcache:{out_dir}',
+            f'--os:{nim_platform}',
+            f'--cpu:{nim_arch}',
+            f'--cc:{cc}',
+            nim_module.name
+        ]
+
+        ic(cli_args)
+
+        code, _, stderr = run_process(
+            cli_args,
+            'NIMPORTER_INSTRUMENT' in os.environ,
+            cwd=compilation_dir
+        )
 
-                    if code:
-                        raise CompilationFailedException(stderr)
+        if code:
+            raise CompilationFailedException(stderr)
 
-                    prevent_win32_max_path_length_error(out_dir)
+        prevent_win32_max_path_length_error(out_dir)
+        ic(store_target(out_dir, ext_dir, manifest), 'new files')
     return
 
 
@@ -1,98 +1,622 @@
 """
-Registers 2 different import functions that allows the importer of this module
-to directly import Nim extension modules & libraries.
-
-Once imported, the importers will be cached in sys.meta_path so any Python
-module can then directly import Nim extensions also. Technically, it's only
-necessary to import Nimporter in the main Python file of a program or in the
-root `__init__.py` of a library.
+Extends Python's import machinery so that the importer of this module can
+directly import Nim extension modules & libraries.
+
+Once imported, a path hook is registered in sys.path_hooks which searches every
+directory for Python modules and Nim extensions alike, along with a fallback
+importer in sys.meta_path, so any Python module can then directly import Nim
+extensions also. Technically, it's only necessary to import Nimporter in the
+main Python file of a program or in the root `__init__.py` of a library.
 """
 
 import sys
 import os
-import shutil
+import json
+import time
+import tempfile
 from pathlib import Path
-from setuptools.extension import Extension
+from contextlib import nullcontext
 from typing import *
-from types import SimpleNamespace
-from icecream import ic
+from types import ModuleType, SimpleNamespace
+from nimporter.instrument import ic
 from nimporter.lib import *
+from nimporter.trace import span
+from nimporter.freeze import is_frozen, get_manifest_path, read_manifest
+from nimporter.cache import (
+    get_build_key,
+    fetch_artifact,
+    fetch_record,
+    fetch_remote_artifact,
+    store_artifact,
+    store_record,
+    store_remote_artifact,
+    use_nimcache,
+)
 
 # NOTE(pbz): https://stackoverflow.com/questions/39660934/error-when-using-importlib-util-to-check-for-library/39661116
 import importlib
+import importlib.abc
+import importlib.machinery
 from importlib import util
+from importlib.machinery import FileFinder
 from _frozen_importlib import ModuleSpec
 from _frozen_importlib_external import _NamespacePath
 
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
 
-def compile_extensions_to_lib(root: Path) -> None:
+def compile_extensions_to_lib(
+    root: Path,
+    jobs: int = 1,
+    profile: Optional[str] = None
+) -> None:
     "Compile all extensions starting at a given path."
+    stale_extensions = []
 
-    for extension_path in ic(find_extensions(ic(root))):
-        if not should_compile(extension_path):
-            ic('Skipping', extension_path)
+    extensions = [
+        get_ext_lib(extension_path, root)
+        for extension_path in ic(find_extensions(ic(root)))
+    ]
+
+    for ext in with_cpu_variants(extensions):
+        if not should_compile(ext, profile):
+            ic('Skipping', ext)
             continue
 
-        compile_extension_to_lib(extension_path)
+        stale_extensions.append(ext)
+
+    for _ in compile_extensions_concurrently(stale_extensions, jobs, profile):
+        pass
+    return
+
+
+def compile_extensions_concurrently(
+    extensions: List[ExtLib],
+    jobs: int = 1,
+    profile: Optional[str] = None
+) -> Iterator[Tuple[ExtLib, float]]:
+    """
+    Compiles extensions on a pool of `jobs` workers.
+
+    The CPUs of the machine are divided between the workers and handed to Nim
+    via `--parallelBuild` so that the C compilers spawned by each concurrent
+    build share one CPU budget.
+
+    Args:
+        extensions(list): the extensions to compile.
+        jobs(int): how many extensions to compile at once.
+        profile(str): the build profile to use instead of the configured one.
+
+    Returns:
+        An iterator of each extension and its build time in seconds, in the
+        order the builds complete.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    # Install Nimpy up front rather than racing to install it in every worker
+    ensure_nimpy()
+
+    parallel_build = get_parallel_build(jobs)
+
+    def build(ext: ExtLib) -> Tuple[ExtLib, float]:
+        start = time.perf_counter()
+        compile_extension_to_lib(ext, parallel_build, profile)
+        return ext, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(build, ext) for ext in extensions]
+
+        for future in as_completed(futures):
+            yield future.result()
+    return
+
+
+def with_cpu_variants(extensions: List[ExtLib]) -> List[ExtLib]:
+    "Adds the configured CPU variants of each extension after it."
+    return [
+        variant
+        for ext in extensions
+        for variant in [ext] + [
+            ext.with_cpu_variant(cpu_variant)
+            for cpu_variant in get_cpu_variants(ext.full_path)
+        ]
+    ]
+
+
+def select_cpu_variant(ext: ExtLib) -> ExtLib:
+    """
+    Returns the most specialized CPU variant of an extension that the host CPU
+    supports, or the baseline extension if there is none.
+    """
+    for cpu_variant in get_cpu_variants(ext.full_path):
+        if is_cpu_variant_supported(cpu_variant):
+            return ext.with_cpu_variant(cpu_variant)
+    return ext
+
+
+# Background builds started by `warm_up()`, keyed by the extension's full path
+_WARM_UP_BUILDS: Dict[Path, 'Future[None]'] = {}
+
+
+def warm_up(
+    root: Optional[Path] = None,
+    jobs: Optional[int] = None
+) -> Dict[str, 'Future[None]']:
+    """
+    Starts compiling every stale extension beneath a folder in the background.
+
+    Meant to be called at the start of a program so that its initialization
+    overlaps with the compilation of its Nim extensions. Importing an
+    extension only waits for the build of that particular extension.
+
+    Args:
+        root(Path): the folder to search for extensions. Defaults to the
+            current directory.
+        jobs(int): how many extensions to compile at once. Defaults to
+            `get_job_count()`.
+
+    Returns:
+        The future of each extension's build, keyed by its import path. Empty
+        when Nimporter is frozen since there is nothing to build.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if is_frozen():
+        return {}
+
+    root = root or Path()
+    jobs = get_job_count(jobs)
+    parallel_build = get_parallel_build(jobs)
+    pool = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='nimporter')
+    builds = {}
+
+    for extension_path in find_extensions(root):
+        ext = select_cpu_variant(get_ext_lib(extension_path, root))
+
+        # Checking whether the extension is stale is also done in the pool
+        build = pool.submit(compile_extension_to_lib, ext, parallel_build)
+        _WARM_UP_BUILDS[ext.full_path] = build
+        builds[ext.import_namespace] = build
+
+    pool.shutdown(wait=False)
+    return ic(builds)
+
+
+def wait_for_warm_up(ext: ExtLib) -> None:
+    """
+    Blocks until the background build of an extension started by `warm_up()`
+    (if any) is finished. A failed build is not raised here but the error is
+    raised again when the extension is compiled by the importing thread.
+    """
+    build = _WARM_UP_BUILDS.get(ext.full_path)
+
+    if build:
+        ic('Waiting for warm up', ext)
+        build.exception()
+    return
+
+
+def write_hash(
+    ext: ExtLib,
+    extension_hash: Optional[Tuple[Fingerprint, bytes]] = None
+) -> None:
+    """
+    Records the hash of an extension next to its build artifact along with
+    the fingerprint of its files so unchanged extensions need not be rehashed.
+
+    Args:
+        ext(ExtLib): the extension to record the hash of.
+        extension_hash(tuple): the fingerprint and hash taken before the
+            extension was compiled. Defaults to the current ones.
+    """
+    fingerprint, digest = (
+        extension_hash or get_extension_hash(ext.relative_path)
+    )
+    write_atomically(ext.hash_filename, digest)
+    write_fingerprint(ext, fingerprint)
     return
 
 
-def write_hash(ext: ExtLib) -> None:
-    ext.hash_filename.parent.mkdir(parents=True, exist_ok=True)
-    ext.hash_filename.write_bytes(hash_extension(ext.relative_path))
+def write_fingerprint(ext: ExtLib, fingerprint: Fingerprint) -> None:
+    # Racy fingerprints are left out so the next check falls back to hashing
+    fingerprint = [] if is_fingerprint_racy(fingerprint) else fingerprint
+    write_atomically(ext.fingerprint_filename, json.dumps(fingerprint).encode())
     return
 
 
+def read_fingerprint(ext: ExtLib) -> Optional[Fingerprint]:
+    try:
+        return [
+            tuple(entry)  # type: ignore[misc]
+            for entry in json.loads(ext.fingerprint_filename.read_text())
+        ]
+    except (OSError, ValueError, TypeError):
+        return None
+
+
 def hash_changed(ext: ExtLib) -> bool:
+    """
+    Determines whether an extension changed since it was last compiled.
+
+    If the size, modification time and inode of each file are the same as
+    when the hash was written, the extension is assumed to be unchanged and
+    is not hashed at all.
+    """
     if not ext.hash_filename.exists():
         return True
 
-    return hash_extension(ext.relative_path) != ext.hash_filename.read_bytes()
+    fingerprint = fingerprint_extension(ext.relative_path)
+
+    if fingerprint and fingerprint == read_fingerprint(ext):
+        return False
+
+    _, digest = get_extension_hash(ext.relative_path)
+
+    if digest != ext.hash_filename.read_bytes():
+        return True
+
+    # The files were touched but not changed so refresh the fingerprint
+    write_fingerprint(ext, fingerprint)
+    return False
 
 
-def should_compile(ext: ExtLib) -> bool:
-    return hash_changed(ext) or not ext.build_artifact.exists()
+def find_dependencies(
+    ext: ExtLib,
+    nimcache: Path,
+    compilation_dir: Path
+) -> List[Path]:
+    """
+    Lists the Nim modules outside of an extension that it depends upon.
 
+    Nim records every module a build imports (directly or transitively) in the
+    build instructions it writes to the nimcache. Modules belonging to the
+    extension itself are left out since they are already covered by its hash,
+    leaving modules from Nimble packages (such as Nimpy) and the stdlib.
 
-def compile_extension_to_lib(ext: ExtLib) -> None:
-    if not should_compile(ext):
+    Args:
+        ext(ExtLib): the extension that was just compiled.
+        nimcache(Path): the nimcache the extension was compiled with.
+        compilation_dir(Path): the folder the extension was compiled in.
+
+    Returns:
+        The sorted absolute paths of the dependencies.
+    """
+    try:
+        instructions = json.loads((nimcache / f'{ext.symbol}.json').read_text())
+    except (OSError, ValueError):
+        return []
+
+    def is_within(path: Path, folder: Path) -> bool:
+        try:
+            path.relative_to(folder)
+            return True
+        except ValueError:
+            return False
+
+    excluded = [compilation_dir.absolute(), ext.full_path.absolute()]
+    dependencies = set()
+
+    for dependency, *_ in instructions.get('depfiles', []):
+        path = Path(dependency).absolute()
+
+        if any(is_within(path, folder) for folder in excluded):
+            continue
+
+        dependencies.add(path)
+
+    return ic(sorted(dependencies))
+
+
+def read_dependency_record(ext: ExtLib) -> Dict[str, Any]:
+    try:
+        return json.loads(ext.dependencies_filename.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def read_dependencies(ext: ExtLib) -> List[Path]:
+    "Returns the dependencies recorded by the last build of an extension."
+    return [Path(i) for i in read_dependency_record(ext).get('files', [])]
+
+
+def write_dependencies(
+    ext: ExtLib,
+    dependencies: List[Path],
+    build_args: List[str],
+    extra_args: Optional[List[str]] = None,
+    profile: Optional[str] = None
+) -> None:
+    """
+    Records the dependencies of an extension along with their hash and
+    fingerprint so that the extension is rebuilt when any of them change.
+    The build arguments are recorded too since changing the build profile
+    must also rebuild the extension, as are the extra arguments of the build
+    so that instrumented builds are never considered up to date. A profile
+    chosen explicitly (as by `nimporter compile --profile`) is recorded so
+    that imports keep using the extension built with it.
+    """
+    fingerprint = fingerprint_files(dependencies)
+
+    write_atomically(ext.dependencies_filename, json.dumps(dict(
+        args=build_args,
+        extra_args=extra_args or [],
+        profile=profile,
+        files=[str(dependency) for dependency in dependencies],
+        fingerprint=[] if is_fingerprint_racy(fingerprint) else fingerprint,
+        hash=hash_files(dependencies).hex(),
+    )).encode())
+    return
+
+
+def dependencies_changed(ext: ExtLib, build_args: List[str]) -> bool:
+    """
+    Determines whether any Nim module an extension imports from outside of
+    itself (or the arguments it is built with) changed since it was last
+    compiled. Like `hash_changed()`, the dependencies are only hashed if their
+    fingerprint changed.
+    """
+    record = read_dependency_record(ext)
+
+    if record.get('args') != build_args:
+        return True
+
+    # Left behind by profile-guided optimization that did not complete
+    if record.get('extra_args') == INSTRUMENT_ARGS:
+        return True
+
+    dependencies = [Path(i) for i in record.get('files', [])]
+    fingerprint = fingerprint_files(dependencies)
+
+    if fingerprint == [tuple(i) for i in record.get('fingerprint', [])]:
+        return False
+
+    if hash_files(dependencies).hex() != record.get('hash'):
+        return True
+
+    # The files were touched but not changed so refresh the fingerprint
+    write_dependencies(
+        ext,
+        dependencies,
+        build_args,
+        record.get('extra_args'),
+        record.get('profile')
+    )
+    return False
+
+
+def make_dependency_record(
+    ext: ExtLib,
+    dependencies: List[Path]
+) -> Dict[str, Any]:
+    """
+    Splits the dependencies of an extension into local ones (such as modules
+    next to an extension module or library), stored relative to the folder
+    containing the extension, and the others from the Nim stdlib and Nimble
+    packages, stored as they are.
+
+    Local dependencies are stored relative to the extension rather than to
+    the root (the cwd for imports) so that the record is the same wherever
+    the checkout is and whichever folder the process runs from.
+    """
+    local, other = [], []
+
+    for dependency in dependencies:
+        try:
+            local.append(
+                dependency.relative_to(ext.full_path.parent).as_posix()
+            )
+        except ValueError:
+            other.append(str(dependency))
+
+    return dict(local=sorted(local), other=sorted(other))
+
+
+def get_recorded_dependencies(
+    ext: ExtLib,
+    record: Dict[str, Any]
+) -> List[Path]:
+    "Returns the paths of the dependencies in a record on this machine."
+    dependencies = [
+        ext.full_path.parent / name for name in record.get('local', [])
+    ]
+    dependencies += [Path(other) for other in record.get('other', [])]
+    return sorted(dependencies)
+
+
+def get_artifact_key(
+    ext: ExtLib,
+    source_hash: bytes,
+    dependencies: List[Path],
+    build_args: List[str]
+) -> str:
+    """
+    Returns the build key of an artifact given its dependencies.
+
+    The contents of every dependency are part of the key (identified by
+    their file name as with `hash_files()`) so that changing any of them
+    misses the cache, as does a dependency missing from this machine.
+    """
+    return get_build_key(
+        ext.symbol, source_hash + hash_files(dependencies), build_args
+    )
+
+
+def get_build_args(ext: ExtLib, profile: Optional[str] = None) -> List[str]:
+    "Returns the Nim CLI arguments to build an extension for the host with."
+    return ALWAYS_ARGS + get_profile_args(ext.full_path, profile) + [
+        # ! Nimporter decides the use of the C compiler that was used
+        # ! to build Python itself to prevent incompatibilities. This
+        # ! is similar to exporting where several C compilers are used.
+        f'--cc:{get_c_compiler_used_to_build_python()}',
+    ]
+
+
+def should_compile(ext: ExtLib, profile: Optional[str] = None) -> bool:
+    """
+    Determines whether an extension is out of date. Without a profile (or
+    `NIMPORTER_PROFILE`), an extension last built with an explicitly chosen
+    profile is compared against that profile rather than the configured one
+    so that importing it does not undo `nimporter compile --profile`.
+    """
+    profile = (
+        profile
+        or os.environ.get('NIMPORTER_PROFILE')
+        or read_dependency_record(ext).get('profile')
+    )
+
+    try:
+        build_args = get_build_args(ext, profile)
+    except NimporterException:
+        # The recorded profile is no longer defined by the project
+        build_args = get_build_args(ext)
+
+    return (
+        hash_changed(ext)
+        or dependencies_changed(ext, build_args)
+        or not ext.build_artifact.exists()
+    )
+
+
+def compile_extension_to_lib(
+    ext: ExtLib,
+    parallel_build: int = 0,
+    profile: Optional[str] = None,
+    extra_args: Optional[List[str]] = None,
+    force: bool = False,
+    nimcache: Optional[Path] = None
+) -> None:
+    """
+    Compiles an extension into its `__pycache__` if it is out of date.
+
+    Args:
+        ext(ExtLib): the extension to compile.
+        parallel_build(int): the number of C compiler processes Nim may use.
+            Zero lets Nim use every CPU.
+        profile(str): the build profile to use instead of the configured one.
+        extra_args(list): Nim CLI arguments for this build only. These are
+            not compared with the arguments of the configured profile, so the
+            artifact is considered up to date by imports using that profile
+            (unless it was instrumented). Such builds are never installed from
+            nor stored in the build caches since their key does not cover
+            everything they depend on, such as a recorded PGO profile.
+        force(bool): compile even if the extension is up to date.
+        nimcache(Path): the nimcache to use instead of the one kept in the
+            cache directory.
+    """
+    if is_frozen():
+        raise CompilationDisabledException(ext.full_path)
+
+    if not force and not should_compile(ext, profile):
         ic('Skipping', ext.full_path)
         return
 
+    # When several processes import a stale extension at once (such as the
+    # workers of a pre-fork server), one builds it while the others wait for
+    # it and then use what it built
+    with file_lock(ext.lock_filename):
+        if not force and not should_compile(ext, profile):
+            ic('Built by another process', ext.full_path)
+            return
+
+        build_extension(ext, parallel_build, profile, extra_args, nimcache)
+    return
+
+
+def build_extension(
+    ext: ExtLib,
+    parallel_build: int = 0,
+    profile: Optional[str] = None,
+    extra_args: Optional[List[str]] = None,
+    nimcache: Optional[Path] = None
+) -> None:
+    """
+    Installs an extension from the build caches or compiles it, whether or
+    not it is out of date. The caller must hold the lock of the extension.
+    Arguments are the same as those of `compile_extension_to_lib()`.
+    """
     ic('Compiling', ext.full_path)
 
-    ensure_nimpy()
+    # Taken before compiling so that edits made during the build are noticed
+    extension_hash = get_extension_hash(ext.relative_path)
+    build_args = get_build_args(ext, profile)
+    all_build_args = build_args + ext.cpu_args + (extra_args or [])
+
+    # The modules an extension imports are only known after compiling it so
+    # the inputs known beforehand find the dependencies of the last build of
+    # those inputs, which then find the artifact if they are unchanged
+    input_key = get_build_key(ext.symbol, extension_hash[1], all_build_args)
+    record = None if extra_args else fetch_record(input_key)
 
     ext.pycache.mkdir(parents=True, exist_ok=True)
 
-    with convert_to_lib_if_needed(ext.full_path) as compilation_dir:
+    if record is not None:
+        dependencies = get_recorded_dependencies(ext, record)
+        build_key = get_artifact_key(
+            ext, extension_hash[1], dependencies, all_build_args
+        )
+
+        with span('cache_fetch', ext=ext, key=build_key) as details:
+            details['hit'] = fetch_artifact(build_key, ext.build_artifact)
+
+        if not details['hit']:
+            with span('remote_cache_fetch', ext=ext, key=build_key) as details:
+                details['hit'] = fetch_remote_artifact(
+                    build_key, ext.build_artifact
+                )
+
+            if details['hit']:
+                store_artifact(build_key, ext.build_artifact)
+
+        if details['hit']:
+            write_hash(ext, extension_hash)
+            write_dependencies(
+                ext,
+                dependencies,
+                build_args,
+                extra_args,
+                profile
+            )
+            return
+
+    ensure_nimpy()
+
+    # The nimcache outlives the build so only changed C code is recompiled
+    nimcache_context = (
+        nullcontext(nimcache) if nimcache
+        else use_nimcache(ext.full_path, all_build_args)
+    )
+
+    # Libraries are compiled within their own folder so each build writes
+    # its artifact to its own folder, or concurrent builds of the CPU
+    # variants of a library would overwrite each other's
+    with convert_to_lib_if_needed(ext.full_path) as compilation_dir, \
+            nimcache_context as nimcache_dir, \
+            tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(tmp)
         nim_module = compilation_dir / (ext.symbol + '.nim')
         ic(nim_module)
 
-        with cd(compilation_dir) as tmp_cwd:
-            cli_args = ALWAYS_ARGS + [
-                # ! Nimporter decides the use of the C compiler that was used
-                # ! to build Python itself to prevent incompatibilities. This
-                # ! is similar to exporting where several C compilers are used.
-                f'--cc:{get_c_compiler_used_to_build_python()}',
-                nim_module.name
-            ]
+        cli_args = all_build_args + get_module_path_args(ext.full_path) + [
+            f'--nimcache:{nimcache_dir}',
+            f'--outdir:{out_dir}',
+            f'--parallelBuild:{parallel_build}',
+            nim_module.name
+        ]
 
-            ic(cli_args)
+        ic(cli_args)
 
+        # Run in the compilation dir without `cd()` so that several
+        # extensions can be compiled at once from different threads
+        with span('nim_compile', ext=ext, args=' '.join(cli_args)):
             code, _, stderr = run_process(
                 cli_args,
-                'NIMPORTER_INSTRUMENT' in os.environ
+                'NIMPORTER_INSTRUMENT' in os.environ,
+                cwd=compilation_dir
             )
 
-            if code:
-                raise CompilationFailedException(stderr)
-
-            # Remove Windows debugging symbols if using MSVC on Win32
-            for debug_ext in ['.exp', '.lib']:
-                debug_file = compilation_dir / (ext.symbol + debug_ext)
-                if debug_file.exists():
-                    ic(debug_file).unlink()
+        if code:
+            raise CompilationFailedException(stderr)
 
         platform = get_host_info()[0]
         find_ext = {WINDOWS: '.dll', MACOS: '.dylib', LINUX: '.so'}[platform]
@@ -101,34 +625,34 @@ def compile_extension_to_lib(ext: ExtLib) -> None:
         # compile the library but didn't write to the standard error stream
         # which is currently not how the Nim compiler behaves.
         # This shouldn't fail.
-        (tmp_build_artifact,) = tmp_cwd.glob(f'*{find_ext}')
+        # Windows debugging symbols (`.exp` and `.lib` files written by MSVC)
+        # are removed along with the folder
+        (tmp_build_artifact,) = out_dir.glob(f'*{find_ext}')
 
-        shutil.move(tmp_build_artifact, ext.build_artifact)
+        with span('artifact_move', ext=ext):
+            move_atomically(tmp_build_artifact, ext.build_artifact)
 
-        write_hash(ext)
-    return
+        dependencies = find_dependencies(ext, nimcache_dir, compilation_dir)
 
+        if not extra_args:
+            build_key = get_artifact_key(
+                ext, extension_hash[1], dependencies, all_build_args
+            )
+            store_artifact(build_key, ext.build_artifact)
+            store_record(input_key, make_dependency_record(ext, dependencies))
 
-def validate_spec(spec: ModuleSpec) -> None:
-    """
-    Validates that a given Nim extension can be successfully imported.
+            # Uploading is only needed by other machines so the import does
+            # not wait for it
+            store_remote_artifact(
+                build_key, ext.build_artifact, background=True
+            )
 
-    Since a spec is used to import a module and the body of this function
-    attempts an import, successful imports will imply importing the module
-    twice. However, it's ok that the module will be imported twice because
-    it's better to have good error messages than to be fast in this case.
+        write_hash(ext, extension_hash)
+        write_dependencies(ext, dependencies, build_args, extra_args, profile)
+    return
 
-    Args:
-        spec(Spec): the spec to validate if its module can be imported.
 
-    Raises:
-        A NimporterException if the spec cannot be used to import the given
-        Nim module/library.
-    """
-    try:
-        util.module_from_spec(spec)
-    except ImportError:
-        msg = '''
+IMPORT_FAILED_MESSAGE: str = '''
         Failed to import Nim extension after successful compilation.
 
         This can be for a variety of reasons.
@@ -161,15 +685,140 @@ def validate_spec(spec: ModuleSpec) -> None:
         OS, Nim output, etc.):
             https://github.com/Pebaz/nimporter/issues/new
         '''
-        raise ImportFailedException(msg)
-    return
+
+
+class NimExtensionLoader(importlib.machinery.ExtensionFileLoader):
+    """
+    Loads a compiled Nim extension and validates that it can be imported.
+
+    Validation used to load the extension once before handing the spec to
+    Python's import machinery which loaded it again, running the module
+    initialization of every Nim extension twice. Instead, failures to load
+    the extension are caught as they happen and turned into an
+    ImportFailedException with advice on how to fix them.
+    """
+    def create_module(self, spec: ModuleSpec) -> ModuleType:
+        with span('load', fullname=spec.name, path=spec.origin):
+            try:
+                return super().create_module(spec)
+            except ImportError as error:
+                raise ImportFailedException(IMPORT_FAILED_MESSAGE) from error
+
+
+class LazyNimLoader(importlib.abc.Loader):
+    """
+    Compiles and loads a Nim extension into an already created module.
+
+    Wrapped in `importlib.util.LazyLoader` so that checking whether the
+    extension is stale, compiling it and loading it are all deferred until an
+    attribute of the module is first accessed.
+    """
+    def __init__(self, ext: ExtLib) -> None:
+        self.ext = ext
+        return
+
+    def exec_module(self, module: ModuleType) -> None:
+        wait_for_warm_up(self.ext)
+        compile_extension_to_lib(self.ext)
+
+        spec = get_spec(module.__name__, self.ext)
+        extension = spec.loader.create_module(spec)
+        spec.loader.exec_module(extension)
+
+        # Single-phase initialization registers the extension in sys.modules
+        # but the lazy module must remain the module that was imported
+        if sys.modules.get(module.__name__) is extension:
+            sys.modules[module.__name__] = module
+
+        module.__dict__.update(
+            (key, value) for key, value in vars(extension).items()
+            if key not in {'__name__', '__loader__', '__package__', '__spec__'}
+        )
+        return
+
+
+def is_lazy() -> bool:
+    "Lazy imports are enabled by defining NIMPORTER_LAZY in the environment."
+    return os.environ.get('NIMPORTER_LAZY', '0') not in ('', '0')
+
+
+def get_spec(fullname: str, ext: ExtLib, lazy: bool = False) -> ModuleSpec:
+    """
+    Returns a Spec that loads the build artifact of an extension.
+
+    Args:
+        fullname(str): the name given when importing the module in Python.
+        ext(ExtLib): the extension to load.
+        lazy(bool): defer compiling and loading the extension until one of
+            its attributes is accessed.
+    """
+    location = str(ext.build_artifact.resolve().absolute())
+    loader = (
+        util.LazyLoader(LazyNimLoader(ext)) if lazy
+        else NimExtensionLoader(fullname, location)
+    )
+    return util.spec_from_file_location(
+        fullname,
+        location=location,
+        loader=loader
+    )
+
+
+def lazy_import(fullname: str) -> ModuleType:
+    """
+    Imports a Nim extension without compiling or loading it until one of its
+    attributes is accessed.
+
+    Useful for programs that import many extensions but only use some of them
+    each run. Defining NIMPORTER_LAZY in the environment makes every import of
+    a Nim extension behave this way.
+
+    Args:
+        fullname(str): the name of the extension as it would be imported.
+
+    Returns:
+        The module of the extension.
+
+    Raises:
+        ModuleNotFoundError if no Nim extension of the given name exists.
+    """
+    if fullname in sys.modules:
+        return sys.modules[fullname]
+
+    # Frozen extensions are already built so there is nothing to defer
+    if is_frozen():
+        return importlib.import_module(fullname)
+
+    parent_name, _, child_name = fullname.rpartition('.')
+    parent = importlib.import_module(parent_name) if parent_name else None
+    path = getattr(parent, '__path__', None)
+
+    spec = (
+        nimport(fullname, path, library=True, lazy=True)
+        or nimport(fullname, path, library=False, lazy=True)
+    )
+
+    if not spec:
+        raise ModuleNotFoundError(
+            f'No Nim extension named {fullname!r}', name=fullname
+        )
+
+    module = util.module_from_spec(spec)
+    sys.modules[fullname] = module
+    spec.loader.exec_module(module)
+
+    if parent:
+        setattr(parent, child_name, module)
+
+    return module
 
 
 def nimport(
     fullname: str,
     path: Optional[Union[List[str], _NamespacePath]],
     *,
-    library: bool
+    library: bool,
+    lazy: Optional[bool] = None
 ) -> Optional[ModuleSpec]:
     """
     Search for, compile, and return Spec for module loaders.
@@ -181,6 +830,8 @@ def nimport(
         fullname(str): the name given when importing the module in Python.
         path(list): additional search paths.
         library(bool): indicates whether or not to compile as a library.
+        lazy(bool): defer compilation until the module is first used.
+            Defaults to whether NIMPORTER_LAZY is defined.
 
     Returns:
         A Spec object that can be used to import the (now compiled) Nim
@@ -194,93 +845,336 @@ def nimport(
     # NOTE(pbz): Package is different based only on `library`
     package = '/'.join(parts)
 
-    search_paths = {
-        Path(i)
-        for i in (path + sys.path + ['.'])
-        if Path(i).is_dir()
-    }
+    # Libraries are folders named after the module so look in their parent
+    parent_package = '/'.join(parts[:-1]) if library else package
+    cwd = os.getcwd()
+    module_path = None
 
-    for the_search_path in search_paths:
-        search_path = (the_search_path / package)
+    with span('find_spec', fullname=fullname, library=library) as details:
+        for the_search_path in dict.fromkeys(path + sys.path + ['.']):
+            search_dir = os.path.join(
+                cwd, the_search_path or '.', parent_package
+            )
+            modules, libraries = index_directory(os.path.normpath(search_dir))
 
-        # Can't be a library without <libname>.nimble
-        if library and not any(search_path.glob(f'{module}.nimble')):
-            continue
+            # Reject the vast majority of imports which are not Nim extensions
+            if module not in (libraries if library else modules):
+                continue
 
-        # Derive module path regardless of library or module
-        module_path = search_path / module_file
+            # Derive module path regardless of library or module
+            module_path = Path(the_search_path or '.') / package / module_file
+            break
+
+        details['found'] = module_path
+
+    if module_path is None:
+        return # type: ignore[return-value]
+
+    return get_extension_spec(fullname, module_path, library, lazy)
 
-        if not module_path.exists():
-            continue
 
-        ic(module_path)
+def get_extension_spec(
+    fullname: str,
+    module_path: Path,
+    library: bool,
+    lazy: Optional[bool] = None
+) -> ModuleSpec:
+    """
+    Compiles an extension that was found if needed and returns its Spec.
 
-        ext = ExtLib(module_path, Path(), library)
-        ic(ext)
+    Args:
+        fullname(str): the name given when importing the module in Python.
+        module_path(Path): the Nim module (or main module of the library).
+        library(bool): indicates whether or not to compile as a library.
+        lazy(bool): defer compilation until the module is first used.
+            Defaults to whether NIMPORTER_LAZY is defined.
+    """
+    ic(module_path)
+
+    ext = select_cpu_variant(ExtLib(module_path, Path(), library))
+    ic(ext)
 
+    lazy = is_lazy() if lazy is None else lazy
+
+    if not lazy:
+        wait_for_warm_up(ext)
         compile_extension_to_lib(ext)
 
-        spec = util.spec_from_file_location(
-            fullname,
-            location=str(ext.build_artifact.resolve().absolute())
-        )
+    spec = get_spec(fullname, ext, lazy)
+
+    ic(spec)
+    ic(ext.__dict__)
+
+    return spec
+
+
+# The artifact of every extension in the manifest when Nimporter is frozen
+_FROZEN_ARTIFACTS: Dict[str, Path] = {}
+
+
+def find_frozen_spec(fullname: str) -> Optional[ModuleSpec]:
+    "Returns the Spec of a frozen extension without touching the file system."
+    artifact = _FROZEN_ARTIFACTS.get(fullname)
+
+    if artifact is None:
+        return None
+
+    location = str(artifact)
+    return util.spec_from_file_location(
+        fullname,
+        location=location,
+        loader=NimExtensionLoader(fullname, location)
+    )
+
 
-        ic(spec)
-        ic(ext.__dict__)
+# Maps a directory to its modification time and the names of the Nim modules
+# and Nim libraries within it.
+_DIRECTORY_INDEX: Dict[str, Tuple[int, FrozenSet[str], FrozenSet[str]]] = {}
 
-        validate_spec(spec)
+
+def index_directory(directory: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """
+    Lists the names of the Nim modules and Nim libraries within a directory.
+
+    The listing is cached until the modification time of the directory changes
+    or `importlib.invalidate_caches()` is called. This allows imports of Python
+    modules to be rejected without touching the file system any further.
+
+    Args:
+        directory(str): the absolute path of the directory to index.
+
+    Returns:
+        The names of `<name>.nim` files and of `<name>/` folders containing
+        both `<name>.nim` and `<name>.nimble`.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return frozenset(), frozenset()
+
+    cached = _DIRECTORY_INDEX.get(directory)
+
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    modules = set()
+    libraries = set()
+
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        entries = []
+
+    for entry in entries:
+        name = entry.name
+
+        if name.endswith('.nim') and entry.is_file():
+            modules.add(name[:-len('.nim')])
+
+        elif entry.is_dir() and all(
+            os.path.isfile(os.path.join(entry.path, name + suffix))
+            for suffix in ('.nimble', '.nim')
+        ):
+            libraries.add(name)
+
+    index = mtime, frozenset(modules), frozenset(libraries)
+    _DIRECTORY_INDEX[directory] = index
+    return index[1], index[2]
+
+
+def invalidate_caches() -> None:
+    """
+    Forgets all indexed directories. Called by `importlib.invalidate_caches()`
+    which is needed when a Nim library is created inside an existing folder
+    since that does not change the modification time of its parent folder.
+    """
+    _DIRECTORY_INDEX.clear()
+    return
+
+
+class NimSourceLoader(importlib.abc.Loader):
+    """
+    Marks `.nim` files in the loader details of NimFileFinder. Only used to
+    recognize Nim modules, NimFileFinder replaces it with a loader for the
+    compiled extension.
+    """
+    def __init__(self, fullname: str, path: str) -> None:
+        self.name = fullname
+        self.path = path
+        return
+
+
+class NimFileFinder(FileFinder):
+    """
+    Finds Python modules like the default FileFinder as well as Nim modules and
+    Nim libraries within one entry of `sys.path` (or of a package's path).
+
+    Since `.nim` is the last suffix that is searched, Python modules are given
+    precedence over Nim modules. Directory listings are cached by FileFinder
+    and only refreshed when a directory is modified, so imports that are not
+    Nim extensions cost nothing more than they would without Nimporter.
+    """
+    def find_spec(
+        self,
+        fullname: str,
+        target: Optional[ModuleType] = None
+    ) -> Optional[ModuleSpec]:
+        spec = FileFinder.find_spec(self, fullname, target)
+
+        # Nothing or a Python module or package was found. Checked first since
+        # this is by far the most common case
+        if spec is None or (
+            spec.loader is not None
+            and not isinstance(spec.loader, NimSourceLoader)
+        ):
+            return spec
+
+        is_nim_module = spec.loader is not None
+
+        # Libraries are folders which FileFinder found as a namespace package
+        # and are given precedence over Nim modules of the same name
+        name = fullname.rpartition('.')[2]
+        library = Path(self.path) / name / f'{name}.nim'
+
+        if library.is_file() and library.with_suffix('.nimble').is_file():
+            return get_extension_spec(fullname, library, library=True)
+
+        if is_nim_module:
+            return get_extension_spec(
+                fullname, Path(spec.origin), library=False # type: ignore
+            )
 
         return spec
-    return # type: ignore[return-value]
+
+
+LOADER_DETAILS: List[Tuple[Type[importlib.abc.Loader], List[str]]] = [
+    (importlib.machinery.ExtensionFileLoader,
+        importlib.machinery.EXTENSION_SUFFIXES),
+    (importlib.machinery.SourceFileLoader, importlib.machinery.SOURCE_SUFFIXES),
+    (importlib.machinery.SourcelessFileLoader,
+        importlib.machinery.BYTECODE_SUFFIXES),
+    (NimSourceLoader, ['.nim']),
+]
+
+
+def register_path_hook() -> None:
+    """
+    Replaces Python's FileFinder with NimFileFinder for every directory that is
+    searched for modules.
+    """
+    hook = NimFileFinder.path_hook(*LOADER_DETAILS)
+    hook.nimporter = True # type: ignore[attr-defined]
+
+    if any(getattr(item, 'nimporter', False) for item in sys.path_hooks):
+        return
+
+    # The FileFinder hook accepts every directory so it must come after it
+    position = next(
+        (
+            index for index, item in enumerate(sys.path_hooks)
+            if getattr(item, '__qualname__', '').startswith('FileFinder.')
+        ),
+        len(sys.path_hooks)
+    )
+    sys.path_hooks.insert(position, hook)
+
+    # Directories searched before now are cached with the previous finders
+    sys.path_importer_cache.clear()
+    return
+
+
+def use_meta_path() -> bool:
+    """
+    Defining NIMPORTER_META_PATH in the environment searches for extensions
+    using the meta path importers only, as older versions of Nimporter did.
+    """
+    return os.environ.get('NIMPORTER_META_PATH', '0') not in ('', '0')
 
 
 def register_importer(list_position: int, importer: Callable) -> None: # type: ignore[type-arg]
     "Convenience function to insert importers into Python's import machinery."
-    sys.meta_path.insert(list_position, SimpleNamespace(find_spec=importer))
+    sys.meta_path.insert(
+        list_position,
+        SimpleNamespace(find_spec=importer, invalidate_caches=invalidate_caches)
+    )
+    return
+
+
+if use_meta_path():
+    """
+    Extends Python import machinery to be able to import Nim modules.
+
+    NOTE: Must be placed at the back of `sys.meta_path` because Python modules
+    should be given precedence over Nim modules.
+
+    Nim Modules can be placed anywhere that Python modules can. However, if a
+    Python module and a Nim module with the same name are in the same package,
+    the Python module will be imported.
+    """
+    register_importer(
+        -1,
+        lambda fullname, path, _=None: nimport(fullname, path, library=False)
+    )
+
+    """
+    Extends Python import machinery to be able to import Nim libraries.
+
+    NOTE: Must be placed at the front of `sys.meta_path` because of how Python
+    treats folders when imported.
+
+    Before NimLibImporter can attempt to find a folder containing a Nimble file
+    containing dependency info and a corresponding Nim module, Python's import
+    machinery imports the folder as a namespace module type.
+
+    The only way to allow NimLibImporter to get a chance to import Nim
+    libraries is to put it at the front of `sys.meta_path`. However, this has a
+    small side effect of making Nim libraries have precedence over Python
+    namespaces. This should never have any adverse effects since the criterion
+    for a Nim library in relation to Nimporter is to have a folder containing a
+    Nim module and a Nimble file with the same name as the folder. By placing
+    both of those files into a directory, it should be extremely clear that the
+    given folder is a Nim library. Additionally, this also means that a Nim
+    library cannot contain any Python modules.
+    """
+    register_importer(
+        0,
+        lambda fullname, path, _=None: nimport(fullname, path, library=True)
+    )
 
     # Ensure that Nim files won't be passed up because of other Importers.
     sys.path_importer_cache.clear()
     importlib.invalidate_caches()
-    return
 
+else:
+    register_path_hook()
 
-"""
-Extends Python import machinery to be able to import Nim modules.
+    """
+    Falls back to searching the current directory and every entry of `sys.path`
+    for extensions that NimFileFinder could not find, such as extensions within
+    a package that are not on the path of the package.
 
-NOTE: Must be placed at the back of `sys.meta_path` because Python modules
-should be given precedence over Nim modules.
+    NOTE: Placed at the back of `sys.meta_path` so it is only used by imports
+    that would otherwise fail.
+    """
+    register_importer(
+        len(sys.meta_path),
+        lambda fullname, path, _=None: (
+            nimport(fullname, path, library=True)
+            or nimport(fullname, path, library=False)
+        )
+    )
 
-Nim Modules can be placed anywhere that Python modules can. However, if a
-Python module and a Nim module with the same name are in the same package, the
-Python module will be imported.
-"""
-register_importer(
-    -1,
-    lambda fullname, path, _: nimport(fullname, path, library=False)
-)
 
+if is_frozen():
+    """
+    Imports extensions listed in the manifest written by `nimporter freeze`.
 
-"""
-Extends Python import machinery to be able to import Nim libraries.
-
-NOTE: Must be placed at the front of `sys.meta_path` because of how Python
-treats folders when imported.
-
-Before NimLibImporter can attempt to find a folder containing a Nimble file
-containing dependency info and a corresponding Nim module, Python's import
-machinery imports the folder as a namespace module type.
-
-The only way to allow NimLibImporter to get a chance to import Nim libraries is
-to put it at the front of `sys.meta_path`. However, this has a small side
-effect of making Nim libraries have precedence over Python namespaces. This
-should never have any adverse effects since the criterion for a Nim library in
-relation to Nimporter is to have a folder containing a Nim module and a Nimble
-file with the same name as the folder. By placing both of those files into a
-directory, it should be extremely clear that the given folder is a Nim library.
-Additionally, this also means that a Nim library cannot contain any Python
-modules.
-"""
-register_importer(
-    0,
-    lambda fullname, path, _: nimport(fullname, path, library=True)
-)
+    NOTE: Placed at the front of `sys.meta_path` so that frozen extensions are
+    imported without searching `sys.path` at all. Nim extensions that are not
+    in the manifest are still found by the other importers, which then raise
+    CompilationDisabledException rather than compiling them.
+    """
+    _FROZEN_ARTIFACTS.update(read_manifest(get_manifest_path()))
+    register_importer(
+        0, lambda fullname, path, _=None: find_frozen_spec(fullname)
+    )
@@ -0,0 +1,226 @@
+"""
+Builds extensions using profile-guided optimization (PGO).
+
+The workflow has three steps:
+
+1. Each extension is compiled with the C compiler's instrumentation enabled
+   and installed into its `__pycache__` like any other build.
+2. A training command supplied by the user (normally a Python script that
+   imports and exercises the extensions) is run, which makes the instrumented
+   extensions record how they are used.
+3. Each extension is compiled again using the recorded profile and the
+   optimized artifact is installed into its `__pycache__`.
+
+Profiles are stored in the cache directory along with the nimcache they were
+recorded against, keyed by the hash of the extension and its build arguments.
+Until the extension changes, existing profiles are reused and only the last
+step is repeated. Only GCC is supported, which excludes MacOS where `gcc` is
+Clang.
+
+Instrumented builds are never considered up to date by imports. If training or
+the optimized build fails, the instrumented artifacts are removed so that the
+next import rebuilds them normally. Neither kind of build goes through the
+build caches, since an instrumented artifact built elsewhere would record its
+profile on that machine and an optimized one depends on the profile.
+"""
+
+import time
+import shlex
+import shutil
+import warnings
+from typing import *
+from pathlib import Path
+from nimporter.instrument import ic
+from nimporter.lib import *
+from nimporter.cache import get_build_key
+from nimporter.nimporter import compile_extension_to_lib, get_build_args
+
+def get_profile_dir(ext: ExtLib, profile: Optional[str] = None) -> Path:
+    """
+    Returns the folder containing the nimcache and the recorded profile of an
+    extension. The folder changes whenever the extension or its build
+    arguments change.
+    """
+    build_key = get_build_key(
+        ext.symbol,
+        get_extension_hash(ext.relative_path)[1],
+        get_build_args(ext, profile) + ext.cpu_args
+    )
+    return get_cache_dir() / 'pgo' / f'{ext.symbol}-{build_key[:16]}'
+
+
+def has_profile(profile_dir: Path) -> bool:
+    return any(profile_dir.rglob('*.gcda'))
+
+
+def compile_extensions_with_pgo(
+    extensions: List[ExtLib],
+    training_command: str,
+    jobs: int = 1,
+    profile: Optional[str] = None
+) -> Iterator[Tuple[ExtLib, float]]:
+    """
+    Compiles extensions using profile-guided optimization.
+
+    Extensions without a recorded profile are instrumented and the training
+    command is run once for all of them before every extension is compiled
+    again using its profile.
+
+    Args:
+        extensions(list): the extensions to compile.
+        training_command(str): the command exercising the extensions, such as
+            `python benchmark.py`.
+        jobs(int): how many extensions to compile at once.
+        profile(str): the build profile to use instead of the configured one.
+
+    Returns:
+        An iterator of each extension and the time in seconds it took to
+        compile using its profile, in the order the builds complete.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    check_pgo_support()
+
+    ensure_nimpy()
+
+    parallel_build = get_parallel_build(jobs)
+    profile_dirs = {
+        ext.full_path: get_profile_dir(ext, profile) for ext in extensions
+    }
+    untrained = [
+        ext for ext in extensions
+        if not has_profile(profile_dirs[ext.full_path])
+    ]
+
+    # Extensions whose installed artifact is instrumented
+    instrumented: Set[Path] = set()
+
+    def build(ext: ExtLib, args: List[str]) -> Tuple[ExtLib, float]:
+        start = time.perf_counter()
+        compile_extension_to_lib(
+            ext,
+            parallel_build,
+            profile,
+            extra_args=args,
+            force=True,
+            nimcache=profile_dirs[ext.full_path]
+        )
+
+        if args == INSTRUMENT_ARGS:
+            instrumented.add(ext.full_path)
+        else:
+            instrumented.discard(ext.full_path)
+
+        return ext, time.perf_counter() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            if untrained:
+                for ext in untrained:
+                    profile_dir = profile_dirs[ext.full_path]
+                    shutil.rmtree(profile_dir, ignore_errors=True)
+                    profile_dir.mkdir(parents=True)
+
+                for future in as_completed([
+                    pool.submit(build, ext, INSTRUMENT_ARGS)
+                    for ext in untrained
+                ]):
+                    ic('Instrumented', future.result()[0])
+
+                train(training_command)
+                check_training(untrained, profile_dirs, training_command)
+
+            futures = [
+                pool.submit(build, ext, OPTIMIZE_ARGS) for ext in extensions
+            ]
+
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        # Instrumented code must never be left for imports to use
+        for ext in extensions:
+            if ext.full_path in instrumented:
+                invalidate_build(ext)
+    return
+
+
+def check_training(
+    extensions: List[ExtLib],
+    profile_dirs: Dict[Path, Path],
+    training_command: str
+) -> None:
+    """
+    Raises NimporterException if training recorded no profile at all, and
+    warns about each extension that training did not use, which is then
+    compiled without a profile.
+    """
+    unused = [
+        ext for ext in extensions
+        if not has_profile(profile_dirs[ext.full_path])
+    ]
+
+    if len(unused) == len(extensions):
+        raise NimporterException(
+            f'PGO training command `{training_command}` recorded no profile. '
+            'It must import and exercise the extensions being optimized'
+        )
+
+    for ext in unused:
+        warnings.warn(
+            f'PGO training command `{training_command}` did not use '
+            f'{ext.full_path} so it is compiled without a profile'
+        )
+    return
+
+
+def check_pgo_support() -> None:
+    """
+    Raises NimporterException unless the C compiler is GCC. On MacOS, the C
+    compiler is Clang even when invoked as `gcc`, and Clang needs profiles
+    converted with `llvm-profdata` which is not supported.
+    """
+    cc = get_c_compiler_used_to_build_python()
+
+    if get_host_info()[0] == MACOS:
+        raise NimporterException(
+            'Profile-guided optimization is not supported on MacOS since the '
+            'C compiler is Clang'
+        )
+
+    if cc != 'gcc':
+        raise NimporterException(
+            'Profile-guided optimization is only supported with GCC but '
+            f'Python was built with {cc}'
+        )
+    return
+
+
+def invalidate_build(ext: ExtLib) -> None:
+    "Removes the build of an extension so that the next import rebuilds it."
+    ic('Invalidating', ext)
+
+    for path in (
+        ext.build_artifact,
+        ext.hash_filename,
+        ext.fingerprint_filename,
+        ext.dependencies_filename,
+    ):
+        try:
+            path.unlink()
+        except OSError:
+            "Not built"
+    return
+
+
+def train(training_command: str) -> None:
+    "Runs the training command which records a profile for each extension."
+    ic('Training', training_command)
+
+    code, _, _ = run_process(shlex.split(training_command), show_output=True)
+
+    if code:
+        raise NimporterException(
+            f'PGO training command `{training_command}` failed with exit '
+            f'code {code}'
+        )
+    return
@@ -0,0 +1,132 @@
+"""
+Records how long each step of finding, building and loading Nim extensions
+takes.
+
+Steps are recorded as spans using `span()`. Spans are handed to every callback
+registered with `add_hook()` (for instance to feed them into metrics) and, if
+`NIMPORTER_TRACE` is set to a file path, written to that file in the Chrome
+trace event format when the interpreter exits. The file can be opened with
+`chrome://tracing` or https://ui.perfetto.dev.
+
+Spans cost next to nothing when there are no hooks and no trace file.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from typing import *
+from contextlib import contextmanager
+
+
+class Span(NamedTuple):
+    "A finished step of finding, building or loading an extension."
+    name: str
+    start: float  # Seconds, from `time.perf_counter()`
+    duration: float  # Seconds
+    thread: int
+    args: Dict[str, Any]
+
+
+Hook = Callable[[Span], None]
+
+_HOOKS: List[Hook] = []
+_SPANS: List[Span] = []
+_LOCK = threading.Lock()
+_TRACE_FILE: Optional[str] = os.environ.get('NIMPORTER_TRACE') or None
+
+
+def add_hook(callback: Hook) -> None:
+    """
+    Calls `callback` with every Span once it is finished. Callbacks can be
+    called from several threads at once and should return quickly.
+    """
+    with _LOCK:
+        _HOOKS.append(callback)
+    return
+
+
+def remove_hook(callback: Hook) -> None:
+    with _LOCK:
+        _HOOKS.remove(callback)
+    return
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Records the duration of the code within the `with` block.
+
+    Args:
+        name(str): what is being done, such as `nim_compile`.
+        args: details to attach to the span. The yielded dict can be updated
+            within the block to attach details that are only known later.
+    """
+    if not _HOOKS and not _TRACE_FILE:
+        yield args
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield args
+    finally:
+        finished = Span(
+            name,
+            start,
+            time.perf_counter() - start,
+            threading.get_ident(),
+            args
+        )
+
+        with _LOCK:
+            hooks = list(_HOOKS)
+
+            if _TRACE_FILE:
+                _SPANS.append(finished)
+
+        for hook in hooks:
+            hook(finished)
+    return
+
+
+def to_chrome_trace(spans: List[Span]) -> Dict[str, Any]:
+    "Converts spans to the Chrome trace event format, in microseconds."
+    return dict(
+        traceEvents=[
+            dict(
+                name=item.name,
+                cat='nimporter',
+                ph='X',
+                ts=round(item.start * 1e6, 3),
+                dur=round(item.duration * 1e6, 3),
+                pid=os.getpid(),
+                tid=item.thread,
+                args={key: str(value) for key, value in item.args.items()},
+            )
+            for item in spans
+        ],
+        displayTimeUnit='ms',
+    )
+
+
+def write_trace() -> None:
+    "Writes every recorded span to the file named by NIMPORTER_TRACE."
+    if not _TRACE_FILE:
+        return
+
+    with _LOCK:
+        spans = list(_SPANS)
+
+    try:
+        with open(_TRACE_FILE, 'w') as file:
+            json.dump(to_chrome_trace(spans), file)
+    except OSError as error:
+        print(f'Nimporter could not write trace: {error}', file=sys.stderr)
+    return
+
+
+if _TRACE_FILE:
+    atexit.register(write_trace)
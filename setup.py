@@ -14,7 +14,8 @@ setup(
     install_requires=[
         'py-cpuinfo>=9.0.0',  # Auto-detect user architecture
         'icecream>=2.1.3',  # Instrumentation
-        'cookiecutter>=2.1.1'  # Project template
+        'cookiecutter>=2.1.1',  # Project template
+        'tomli>=2.0.1; python_version < "3.11"',  # Build profiles
     ],
     entry_points={
         'console_scripts' : [
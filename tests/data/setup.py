@@ -6,5 +6,6 @@ setup(
     py_modules=['py_module'],
     ext_modules=get_nim_extensions(
         platforms=[WINDOWS, LINUX, MACOS]
-    )
+    ),
+    cmdclass={'build_ext': ParallelBuildExt},
 )
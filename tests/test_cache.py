@@ -0,0 +1,226 @@
+import json
+import time
+import threading
+import contextlib
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from nimporter.cache import *
+
+
+@contextlib.contextmanager
+def stand_in_cache_server(delay: float = 0.0):
+    "Serves blobs from a dict using GET and PUT like a remote build cache."
+    blobs = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            blob = blobs.get(self.path)
+            self.send_response(200 if blob is not None else 404)
+            self.end_headers()
+            self.wfile.write(blob or b'')
+
+        def do_PUT(self):
+            blobs[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(201)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f'http://127.0.0.1:{server.server_port}', blobs
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_backend_round_trip(tmp_path, monkeypatch):
+    "Test artifacts uploaded by one machine are downloaded by another"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    artifact = tmp_path / 'built.so'
+    artifact.write_bytes(b'\x7fELF artifact')
+
+    with stand_in_cache_server() as (url, blobs):
+        set_remote_cache(HttpBackend(url))
+        try:
+            store_remote_artifact('key', artifact)
+            assert fetch_remote_artifact('key', tmp_path / 'fetched.so')
+            assert not fetch_remote_artifact('other', tmp_path / 'other.so')
+        finally:
+            set_remote_cache(None)
+
+    assert (tmp_path / 'fetched.so').read_bytes() == artifact.read_bytes()
+    assert not (tmp_path / 'other.so').exists()
+
+
+def test_corrupt_remote_artifact_is_rejected(tmp_path, monkeypatch):
+    "Test artifacts not matching their content hash are treated as misses"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    artifact = tmp_path / 'built.so'
+    artifact.write_bytes(b'\x7fELF artifact')
+
+    set_remote_cache(FileSystemBackend(tmp_path / 'remote'))
+    try:
+        store_remote_artifact('key', artifact)
+
+        for blob in (tmp_path / 'remote' / 'cas').iterdir():
+            blob.write_bytes(b'tampered')
+
+        assert not fetch_remote_artifact('key', tmp_path / 'fetched.so')
+    finally:
+        set_remote_cache(None)
+
+    assert not (tmp_path / 'fetched.so').exists()
+
+
+def test_slow_remote_cache_falls_back(tmp_path, monkeypatch):
+    "Test a remote cache slower than the timeout is treated as a miss"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('NIMPORTER_REMOTE_CACHE_TIMEOUT', '0.2')
+
+    with stand_in_cache_server(delay=2.0) as (url, blobs):
+        blobs['/ac/key'] = b'0' * 64
+        monkeypatch.setenv('NIMPORTER_REMOTE_CACHE', url)
+
+        start = time.perf_counter()
+        assert not fetch_remote_artifact('key', tmp_path / 'fetched.so')
+        assert time.perf_counter() - start < 1.5
+
+
+def test_uploads_do_not_block_and_are_skipped_when_present(
+    tmp_path, monkeypatch
+):
+    "Test artifacts are uploaded in the background and only once"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    artifact = tmp_path / 'built.so'
+    artifact.write_bytes(b'\x7fELF artifact')
+
+    with stand_in_cache_server(delay=0.5) as (url, blobs):
+        set_remote_cache(HttpBackend(url))
+        try:
+            start = time.perf_counter()
+            store_remote_artifact('key', artifact, background=True)
+            assert time.perf_counter() - start < 0.4
+
+            wait_for_uploads()
+            digest = blobs['/ac/key'].decode()
+            assert set(blobs) == {'/ac/key', f'/cas/{digest}'}
+
+            blobs['/ac/key'] = b'uploaded by another machine'
+            store_remote_artifact('key', artifact)
+            assert blobs['/ac/key'] == b'uploaded by another machine'
+        finally:
+            set_remote_cache(None)
+
+
+def stand_in_compiler(builds, nimpy):
+    """
+    Replaces running `nimble c` with writing an artifact naming the sibling
+    module it was built with, along with the dependencies Nim would list.
+    """
+    def run_process(args, show_output=False, cwd=None):
+        options = dict(arg.split(':', 1) for arg in args if ':' in arg)
+        helper = Path(options['--path']) / 'helper.nim'
+        symbol = Path(args[-1]).stem
+        nimcache = Path(options['--nimcache'])
+        nimcache.mkdir(parents=True, exist_ok=True)
+        (nimcache / f'{symbol}.json').write_text(json.dumps(dict(
+            depfiles=[[str(helper)], [str(nimpy)]]
+        )))
+        (Path(options['--outdir']) / f'{symbol}.so').write_bytes(
+            b'built with ' + helper.read_bytes()
+        )
+        builds.append(helper)
+        return 0, '', ''
+
+    return run_process
+
+
+def test_changed_dependencies_are_never_installed_from_cache(
+    tmp_path, monkeypatch
+):
+    "Test artifacts are shared between checkouts until a dependency changes"
+    import sys
+    from nimporter.lib import ExtLib
+    nimporter = sys.modules['nimporter.nimporter']
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.delenv('NIMPORTER_REMOTE_CACHE', raising=False)
+    monkeypatch.delenv('NIMPORTER_PROFILE', raising=False)
+    nimpy = tmp_path / 'nimble' / 'nimpy.nim'
+    nimpy.parent.mkdir()
+    nimpy.write_text('# nimpy')
+    builds = []
+    monkeypatch.setattr(nimporter, 'ensure_nimpy', lambda: '')
+    monkeypatch.setattr(
+        nimporter, 'run_process', stand_in_compiler(builds, nimpy)
+    )
+
+    for checkout in (tmp_path / 'x', tmp_path / 'y'):
+        (checkout / 'pkg').mkdir(parents=True)
+        (checkout / 'pkg' / 'mod.nim').write_text('import nimpy, helper')
+        (checkout / 'pkg' / 'helper.nim').write_text('v1')
+
+    # Imports run from a folder outside of both checkouts
+    monkeypatch.chdir(tmp_path / 'nimble')
+
+    def build(checkout):
+        ext = ExtLib(checkout / 'pkg' / 'mod.nim', Path(), False)
+        nimporter.build_extension(ext)
+        assert not nimporter.should_compile(ext)
+        return ext.build_artifact.read_bytes()
+
+    assert build(tmp_path / 'x') == b'built with v1'
+    assert len(builds) == 1
+
+    # A fresh checkout is installed from the cache
+    assert build(tmp_path / 'y') == b'built with v1'
+    assert len(builds) == 1
+
+    (tmp_path / 'y' / 'pkg' / 'helper.nim').write_text('v2')
+    assert build(tmp_path / 'y') == b'built with v2'
+    assert len(builds) == 2
+
+    # Other Nim modules (such as those of Nimble packages) are tracked too
+    nimpy.write_text('# nimpy 2')
+    assert build(tmp_path / 'x') == b'built with v1'
+    assert len(builds) == 3
+
+
+def test_local_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    "Test the local cache stays within its maximum size"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('NIMPORTER_CACHE_MAX_SIZE', '2K')
+
+    for key in ('aa', 'bb', 'cc'):
+        artifact = tmp_path / key
+        artifact.write_bytes(b'x' * 1024)
+        store_artifact(key, artifact)
+        time.sleep(0.01)
+
+    assert not fetch_artifact('aa', tmp_path / 'fetched')
+    assert fetch_artifact('cc', tmp_path / 'fetched')
+    assert get_cache_stats()['evictions'] == 1
+
+
+def test_concurrent_stats_are_not_lost(tmp_path, monkeypatch):
+    "Test the cache statistics are locked while being updated"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+
+    def record():
+        for _ in range(20):
+            record_stat('hits')
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert get_cache_stats()['hits'] == 160
@@ -0,0 +1,57 @@
+import os
+import sys
+import subprocess
+from pathlib import Path
+from nimporter.freeze import freeze
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+DATA = REPOSITORY / 'tests' / 'data'
+
+
+def run_frozen(code, manifest):
+    "Runs Python code in a new interpreter with Nimporter frozen."
+    return subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=DATA,
+        env={
+            **os.environ,
+            'PYTHONPATH': str(REPOSITORY),
+            'NIMPORTER_FROZEN': '1',
+            'NIMPORTER_MANIFEST': str(manifest),
+        },
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+def test_frozen_extensions_are_imported_from_manifest(tmp_path):
+    "Test frozen imports use the artifacts listed in the manifest"
+    manifest = tmp_path / 'nimporter-manifest.json'
+    extensions = freeze(DATA, manifest)['extensions']
+    assert {'ext_mod_basic', 'ext_lib_basic'} <= set(extensions)
+
+    process = run_frozen(
+        'import nimporter, ext_mod_basic, ext_lib_basic\n'
+        'assert ext_mod_basic.add(1, 2) == 3\n'
+        'assert ext_lib_basic.add(1, 2) == 3\n',
+        manifest
+    )
+    assert process.returncode == 0, process.stderr
+
+
+def test_frozen_extensions_are_never_compiled(tmp_path):
+    "Test Nim extensions missing from the manifest raise instead of compiling"
+    manifest = tmp_path / 'nimporter-manifest.json'
+    freeze(DATA, manifest)
+
+    process = run_frozen(
+        'import sys, nimporter\n'
+        "sys.modules['nimporter.nimporter']._FROZEN_ARTIFACTS.clear()\n"
+        'import ext_mod_basic\n',
+        manifest
+    )
+    assert 'CompilationDisabledException' in process.stderr
+
+    process = run_frozen('import nimporter', tmp_path / 'missing.json')
+    assert 'nimporter freeze' in process.stderr
@@ -0,0 +1,105 @@
+import os
+from pathlib import Path
+from nimporter.lib import *
+
+
+def make_library(folder: Path) -> Path:
+    library = folder / 'lib'
+    (library / 'src').mkdir(parents=True)
+    (library / '.git').mkdir()
+    (library / 'nimcache').mkdir()
+    (library / 'lib.nim').write_text('import src/helper')
+    (library / 'lib.nimble').write_text('requires "nimpy"')
+    (library / 'lib.nim.cfg').write_text('')
+    (library / 'src' / 'helper.nim').write_text('')
+    (library / 'src' / 'data.bin').write_bytes(b'data')
+    (library / '.git' / 'HEAD').write_text('ref: refs/heads/master')
+    (library / 'nimcache' / 'lib.c').write_text('')
+    return library
+
+
+def test_only_build_inputs_are_hashed(tmp_path):
+    "Test data files, version control and nimcache folders are not hashed"
+    library = make_library(tmp_path)
+    files = [
+        item.relative_to(library).as_posix()
+        for item in iterate_extension_files(library)
+    ]
+    assert files == ['lib.nim', 'lib.nim.cfg', 'lib.nimble', 'src/helper.nim']
+
+    digest = hash_extension(library)
+    (library / 'src' / 'data.bin').write_bytes(b'changed')
+    (library / '.git' / 'HEAD').write_text('ref: refs/heads/other')
+    assert hash_extension(library) == digest
+
+    (library / 'src' / 'helper.nim').write_text('proc helper() = discard')
+    assert hash_extension(library) != digest
+
+
+def test_hash_patterns_are_configurable(tmp_path):
+    "Test pyproject.toml can choose which files of a library are hashed"
+    library = make_library(tmp_path)
+    (tmp_path / 'pyproject.toml').write_text(
+        '[tool.nimporter]\n'
+        'hash_include = ["*.nim", "*.nimble", "*.bin"]\n'
+        'hash_ignore = ["src"]\n'
+    )
+    files = [
+        item.relative_to(library).as_posix()
+        for item in iterate_extension_files(library)
+    ]
+    assert files == ['lib.nim', 'lib.nimble']
+
+
+def get_key(ext, dependencies):
+    """
+    Returns the dependencies an extension would record in the cache and the
+    build key it would be cached with.
+    """
+    from nimporter.nimporter import (
+        get_artifact_key, get_recorded_dependencies, make_dependency_record
+    )
+    _, source_hash = get_extension_hash(ext.relative_path)
+    record = make_dependency_record(ext, dependencies)
+    dependencies = get_recorded_dependencies(ext, record)
+    key = get_artifact_key(ext, source_hash, dependencies, ['-d:release'])
+    return tuple(record['local']), key
+
+
+def test_keys_do_not_depend_on_cwd_or_checkout(tmp_path, monkeypatch):
+    "Test unchanged extensions have the same key in any checkout and any cwd"
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    checkouts = [tmp_path / 'ci' / 'job1', tmp_path / 'home' / 'dev' / 'repo']
+    keys = set()
+
+    for checkout in checkouts:
+        make_library(checkout)
+        module = checkout / 'pkg' / 'mod.nim'
+        module.parent.mkdir()
+        module.write_text('import nimpy, helper')
+        helper = checkout / 'pkg' / 'helper.nim'
+        helper.write_text('proc helper*() = discard')
+
+        # The same Nimble package installed in different places
+        nimpy = checkout / 'nimble' / 'pkgs' / 'nimpy-0.2.0' / 'nimpy.nim'
+        nimpy.parent.mkdir(parents=True)
+        nimpy.write_text('# nimpy')
+
+        # Imports use the cwd as the root and the path they were found at
+        (tmp_path / 'a_work').mkdir(exist_ok=True)
+
+        for cwd in (checkout, tmp_path, tmp_path / 'a_work'):
+            monkeypatch.chdir(cwd)
+            found_at = Path(os.path.relpath(checkout, cwd))
+            keys.add((
+                get_key(ExtLib(found_at / 'lib' / 'lib.nim', Path(), True), [
+                    nimpy
+                ]),
+                get_key(ExtLib(found_at / 'pkg' / 'mod.nim', Path(), False), [
+                    nimpy, helper.resolve()
+                ]),
+            ))
+
+    assert len(keys) == 1
+    ((_, (local, _)),) = keys
+    assert local == ('helper.nim',)
@@ -0,0 +1,34 @@
+import os
+import pytest
+from nimporter.lib import *
+
+
+def test_job_count_precedence(monkeypatch):
+    "Test explicit job counts win over the environment and the CPU count"
+    monkeypatch.delenv('NIMPORTER_JOBS', raising=False)
+    assert get_job_count() == (os.cpu_count() or 1)
+    assert get_job_count(0) == (os.cpu_count() or 1)
+    assert get_job_count(3) == 3
+
+    monkeypatch.setenv('NIMPORTER_JOBS', ' 5 ')
+    assert get_job_count() == 5
+    assert get_job_count(None) == 5
+    assert get_job_count(3) == 3
+
+    monkeypatch.setenv('NIMPORTER_JOBS', '')
+    assert get_job_count() == (os.cpu_count() or 1)
+
+
+@pytest.mark.parametrize('value', ['many', '0', '-2', '1.5'])
+def test_invalid_job_counts_are_rejected(monkeypatch, value):
+    "Test invalid job counts are reported along with where they came from"
+    monkeypatch.setenv('NIMPORTER_JOBS', value)
+
+    with pytest.raises(NimporterException, match='NIMPORTER_JOBS'):
+        get_job_count()
+
+    # An explicit job count does not read the environment at all
+    assert get_job_count(2) == 2
+
+    with pytest.raises(NimporterException, match='positive'):
+        get_job_count(-1)
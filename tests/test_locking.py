@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+from pathlib import Path
+from nimporter.lib import *
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+
+HOLD_LOCK = '''
+import sys, time
+from pathlib import Path
+from nimporter.lib import file_lock
+
+with file_lock(Path(sys.argv[1])):
+    with open(sys.argv[2], 'a') as log:
+        log.write('start\\n')
+        log.flush()
+        time.sleep(0.3)
+        log.write('end\\n')
+'''
+
+
+def test_file_lock_is_held_across_processes(tmp_path):
+    "Test two processes taking the same lock never hold it at once"
+    lock, log = tmp_path / 'ext.lock', tmp_path / 'log'
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-c', HOLD_LOCK, str(lock), str(log)],
+            env={**os.environ, 'PYTHONPATH': str(REPOSITORY)},
+        )
+        for _ in range(2)
+    ]
+
+    assert [process.wait() for process in processes] == [0, 0]
+    assert log.read_text().split() == ['start', 'end', 'start', 'end']
+
+
+def test_concurrent_builds_are_serialized_and_atomic(tmp_path, monkeypatch):
+    "Test an extension imported by several threads at once is built once"
+    nimporter = sys.modules['nimporter.nimporter']
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    (tmp_path / 'mod.nim').write_text('import nimpy')
+    ext = ExtLib(tmp_path / 'mod.nim', tmp_path, False)
+    artifact = b'\x7fELF' + b'\0' * (1 << 20)
+    builds = []
+    torn = []
+    done = threading.Event()
+
+    def build_extension(ext, *args):
+        builds.append(threading.get_ident())
+        extension_hash = get_extension_hash(ext.relative_path)
+        ext.pycache.mkdir(parents=True, exist_ok=True)
+
+        # Written slowly like a linker would so that readers could see it
+        partial = tmp_path / 'partial.so'
+
+        with open(partial, 'wb') as file:
+            for offset in range(0, len(artifact), 1 << 16):
+                file.write(artifact[offset:offset + (1 << 16)])
+                file.flush()
+                time.sleep(0.005)
+
+        move_atomically(partial, ext.build_artifact)
+        nimporter.write_hash(ext, extension_hash)
+        nimporter.write_dependencies(ext, [], nimporter.get_build_args(ext))
+
+    def read_artifact():
+        while not done.is_set():
+            try:
+                data = ext.build_artifact.read_bytes()
+            except OSError:
+                continue
+
+            if data != artifact:
+                torn.append(len(data))
+
+    monkeypatch.setattr(nimporter, 'build_extension', build_extension)
+    reader = threading.Thread(target=read_artifact)
+    reader.start()
+
+    try:
+        threads = [
+            threading.Thread(
+                target=nimporter.compile_extension_to_lib, args=(ext,)
+            )
+            for _ in range(4)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+    finally:
+        done.set()
+        reader.join()
+
+    assert len(builds) == 1
+    assert not torn
+    assert ext.build_artifact.read_bytes() == artifact
+    assert not list(ext.pycache.glob('*.tmp'))
@@ -1,5 +1,8 @@
 import sys
+import json
+import pytest
 import shlex
+import sysconfig
 from zipfile import ZipFile
 from tests import temporarily_install_nimporter
 from nimporter.lib import *
@@ -38,13 +41,19 @@ def test_sdist_all_targets_builds_correctly():
             }
 
             important_names = set()
+            nimbase_headers = set()
 
             for platform, arch, compiler in iterate_target_triples(PLATFORMS):
                 triple = f'{platform}-{arch}-{compiler}'
 
                 for important_name in IMPORTANT_NAMES:
-                    important_names.add(
-                        f'{PREFIX}/{important_name}/{triple}/nimbase.h'
+                    manifest = f'{PREFIX}/{important_name}/{triple}.json'
+                    important_names.add(manifest)
+
+                    files = json.loads(archive.read(manifest))['files']
+                    nimbase_headers.add(f'{PREFIX}/{files["nimbase.h"]}')
+                    important_names.update(
+                        f'{PREFIX}/{location}' for location in files.values()
                     )
 
             ALL_NAMES = {*archive.namelist()}
@@ -54,6 +63,9 @@ def test_sdist_all_targets_builds_correctly():
                     f'{important_name} was not included in the zip archive'
                 )
 
+            # Identical files are only included once
+            assert len(nimbase_headers) == 1
+
 
 def test_bdist_wheel_all_targets_installs_correctly():
     "Assert all items are correctly imported"
@@ -194,3 +206,103 @@ def test_setup_py_all_targets_installs_correctly():
             shlex.split(f'{PYTHON} -m pip uninstall test_nimporter -y'),
             'NIMPORTER_INSTRUMENT' in os.environ
         )
+
+
+def test_build_ext_compiles_in_parallel(tmp_path):
+    "Assert every extension is built when compiling C files concurrently"
+    with temporarily_install_nimporter(), cd(Path('tests/data')):
+        code, stdout, stderr = run_process(
+            shlex.split(
+                f'{PYTHON} setup.py build_ext -j2'
+                f' --build-lib {tmp_path / "lib"}'
+                f' --build-temp {tmp_path / "temp"}'
+            ),
+            'NIMPORTER_INSTRUMENT' in os.environ
+        )
+
+        assert code == 0, f'{stdout}\n\n\n{stderr}'
+
+    suffix = sysconfig.get_config_var('EXT_SUFFIX')
+    built = {
+        '.'.join(path.relative_to(tmp_path / 'lib').parts)[:-len(suffix)]
+        for path in (tmp_path / 'lib').rglob(f'*{suffix}')
+    }
+
+    assert built == {
+        'ext_mod_basic',
+        'ext_lib_basic',
+        'pkg1.pkg2.ext_mod_in_pack',
+        'pkg1.pkg2.ext_lib_in_pack',
+    }
+
+
+def stand_in_project(root):
+    "Creates a project with one extension module and one extension library."
+    (root / 'mod.nim').write_text('import nimpy')
+    (root / 'lib').mkdir()
+    (root / 'lib' / 'lib.nim').write_text('import nimpy')
+    (root / 'lib' / 'lib.nimble').write_text('requires "nimpy"')
+
+
+def test_targets_are_compiled_to_c_concurrently(tmp_path, monkeypatch):
+    "Assert modules are compiled concurrently but libraries one at a time"
+    import time
+    import threading
+    nexporter = sys.modules['nimporter.nexporter']
+    stand_in_project(tmp_path)
+    lock = threading.Lock()
+    running = {'mod': set(), 'lib': set()}
+    most_running = {'mod': 0, 'lib': 0}
+
+    def compile_extension_to_c(extension_path, root, ext_dir, triple, profile):
+        name = extension_path.stem
+
+        with lock:
+            running[name].add(triple)
+            most_running[name] = max(most_running[name], len(running[name]))
+
+        time.sleep(0.05)
+
+        with lock:
+            running[name].remove(triple)
+
+    monkeypatch.setattr(nexporter, 'ensure_nimpy', lambda: '')
+    monkeypatch.setattr(
+        nexporter, 'compile_extension_to_c', compile_extension_to_c
+    )
+    compile_extensions_to_c([WINDOWS, LINUX], tmp_path, jobs=4)
+
+    assert most_running['mod'] > 1
+    assert most_running['lib'] == 1
+
+
+def test_every_failing_target_is_reported(tmp_path, monkeypatch):
+    "Assert failures of some targets are reported after the others finish"
+    nexporter = sys.modules['nimporter.nexporter']
+    stand_in_project(tmp_path)
+    compiled = []
+
+    def compile_extension_to_c(extension_path, root, ext_dir, triple, profile):
+        if triple[0] == WINDOWS:
+            raise CompilationFailedException(b'nim failed')
+
+        if extension_path.is_dir() and triple[0] == MACOS:
+            raise OSError('nimble is missing')
+
+        compiled.append((extension_path.stem, triple))
+
+    monkeypatch.setattr(nexporter, 'ensure_nimpy', lambda: '')
+    monkeypatch.setattr(
+        nexporter, 'compile_extension_to_c', compile_extension_to_c
+    )
+
+    with pytest.raises(CompilationFailedException) as error:
+        compile_extensions_to_c([WINDOWS, LINUX, MACOS], tmp_path, jobs=2)
+
+    message = str(error.value)
+    assert 'mod for windows-x86_64-vcc:\nnim failed' in message
+    assert 'lib for windows-x86_32-gcc:\nnim failed' in message
+    assert 'lib for darwin-x86_64-gcc:\nOSError: nimble is missing' in message
+
+    # Linux for both extensions and MacOS for the module
+    assert len(compiled) == 6
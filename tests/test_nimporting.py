@@ -1,4 +1,5 @@
 import sys
+import nimporter
 
 sys.path.append('tests/data')
 
@@ -58,3 +59,20 @@ def test_excached_ext_lib_in_pack():
     sys.modules.pop('pkg1.pkg2.ext_lib_in_pack', None)
     import pkg1.pkg2.ext_lib_in_pack
     assert pkg1.pkg2.ext_lib_in_pack.add(1, 2) == 3
+
+
+def test_lazy_ext_lib_basic():
+    "Test lazily importing an extension library loads it on first use"
+    sys.modules.pop('ext_lib_basic', None)
+    ext_lib_basic = nimporter.lazy_import('ext_lib_basic')
+    assert ext_lib_basic.add(1, 2) == 3
+    assert sys.modules['ext_lib_basic'] is ext_lib_basic
+
+
+def test_ext_found_by_path_hook():
+    "Test extensions are found by the finder of their sys.path entry"
+    from nimporter.nimporter import NimFileFinder
+    sys.modules.pop('ext_mod_basic', None)
+    import ext_mod_basic
+    assert ext_mod_basic.add(1, 2) == 3
+    assert isinstance(sys.path_importer_cache['tests/data'], NimFileFinder)
@@ -0,0 +1,166 @@
+import pytest
+from nimporter import pgo
+from nimporter.lib import *
+
+
+@pytest.fixture
+def extensions(tmp_path, monkeypatch):
+    "Two extension modules built by a stand-in for the compiler."
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(pgo, 'ensure_nimpy', lambda: '')
+    monkeypatch.setattr(
+        pgo, 'get_c_compiler_used_to_build_python', lambda: 'gcc'
+    )
+    monkeypatch.setattr(
+        pgo, 'get_host_info', lambda: (LINUX, 'x86_64', 'gcc')
+    )
+    extensions = []
+
+    for name in ('one', 'two'):
+        (tmp_path / f'{name}.nim').write_text('import nimpy')
+        extensions.append(ExtLib(tmp_path / f'{name}.nim', tmp_path, False))
+
+    return extensions
+
+
+def stand_in_build(events):
+    "Records each build and installs an artifact like a real build would."
+    def compile_extension_to_lib(ext, *args, extra_args=None, **kwargs):
+        from nimporter.nimporter import write_dependencies
+        events.append((ext.symbol, extra_args))
+        ext.pycache.mkdir(exist_ok=True)
+        ext.build_artifact.write_bytes(b'\x7fELF')
+        write_dependencies(ext, [], ['-d:release'], extra_args)
+
+    return compile_extension_to_lib
+
+
+def test_extensions_are_instrumented_trained_then_optimized(
+    extensions, monkeypatch
+):
+    "Test each step of PGO is run in order with its compiler flags"
+    events = []
+    monkeypatch.setattr(
+        pgo, 'compile_extension_to_lib', stand_in_build(events)
+    )
+
+    def run_process(args, show_output=False):
+        events.append(('train', args))
+
+        # Training writes a profile next to the objects of each extension
+        for ext in extensions:
+            (pgo.get_profile_dir(ext) / f'{ext.symbol}.gcda').touch()
+
+        return 0, '', ''
+
+    monkeypatch.setattr(pgo, 'run_process', run_process)
+    list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
+
+    assert sorted(events[:2]) == [
+        ('one', INSTRUMENT_ARGS), ('two', INSTRUMENT_ARGS)
+    ]
+    assert events[2] == ('train', ['python', 'bench.py'])
+    assert sorted(events[3:]) == [
+        ('one', OPTIMIZE_ARGS), ('two', OPTIMIZE_ARGS)
+    ]
+    assert '--passC:-fprofile-generate' in INSTRUMENT_ARGS
+    assert '--passC:-fprofile-use' in OPTIMIZE_ARGS
+
+    # Recorded profiles are reused until the extensions change
+    events.clear()
+    list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
+    assert sorted(events) == [('one', OPTIMIZE_ARGS), ('two', OPTIMIZE_ARGS)]
+
+
+def test_failed_training_removes_instrumented_builds(extensions, monkeypatch):
+    "Test imports never keep using instrumented builds"
+    from nimporter.nimporter import dependencies_changed
+    events = []
+    monkeypatch.setattr(
+        pgo, 'compile_extension_to_lib', stand_in_build(events)
+    )
+    monkeypatch.setattr(pgo, 'run_process', lambda *args, **kw: (1, '', ''))
+
+    with pytest.raises(NimporterException):
+        list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
+
+    assert events
+
+    for ext in extensions:
+        assert not ext.build_artifact.exists()
+        assert not ext.dependencies_filename.exists()
+
+    # Even without cleaning up, instrumented builds are out of date
+    stand_in_build(events)(extensions[0], extra_args=INSTRUMENT_ARGS)
+    assert dependencies_changed(extensions[0], ['-d:release'])
+
+    stand_in_build(events)(extensions[0], extra_args=OPTIMIZE_ARGS)
+    assert not dependencies_changed(extensions[0], ['-d:release'])
+
+
+def test_training_must_record_a_profile(extensions, monkeypatch):
+    "Test training that uses no extension fails and partial training warns"
+    events = []
+    monkeypatch.setattr(
+        pgo, 'compile_extension_to_lib', stand_in_build(events)
+    )
+    monkeypatch.setattr(pgo, 'run_process', lambda *args, **kw: (0, '', ''))
+
+    with pytest.raises(NimporterException, match='recorded no profile'):
+        list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
+
+    assert not any(ext.build_artifact.exists() for ext in extensions)
+
+    def run_process(args, show_output=False):
+        (pgo.get_profile_dir(extensions[0]) / 'one.gcda').touch()
+        return 0, '', ''
+
+    monkeypatch.setattr(pgo, 'run_process', run_process)
+
+    with pytest.warns(UserWarning, match='two.nim'):
+        list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
+
+
+def test_pgo_builds_bypass_the_build_caches(tmp_path, monkeypatch):
+    "Test instrumented and optimized artifacts are never shared"
+    import sys
+    from tests.test_cache import stand_in_compiler
+    nimporter = sys.modules['nimporter.nimporter']
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.delenv('NIMPORTER_REMOTE_CACHE', raising=False)
+    nimpy = tmp_path / 'nimpy.nim'
+    nimpy.write_text('# nimpy')
+    builds = []
+    monkeypatch.setattr(nimporter, 'ensure_nimpy', lambda: '')
+    monkeypatch.setattr(
+        nimporter, 'run_process', stand_in_compiler(builds, nimpy)
+    )
+    (tmp_path / 'mod.nim').write_text('import nimpy, helper')
+    (tmp_path / 'helper.nim').write_text('v1')
+    ext = ExtLib(tmp_path / 'mod.nim', tmp_path, False)
+
+    for _ in range(2):
+        nimporter.build_extension(ext, extra_args=OPTIMIZE_ARGS)
+
+    assert len(builds) == 2
+    assert not (tmp_path / 'cache' / 'artifacts').exists()
+
+
+def test_pgo_requires_gcc(extensions, monkeypatch):
+    "Test compilers that are not GCC (including MacOS' gcc) are rejected"
+    monkeypatch.setattr(
+        pgo, 'get_host_info', lambda: (MACOS, 'x86_64', 'gcc')
+    )
+
+    with pytest.raises(NimporterException, match='MacOS'):
+        list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
+
+    monkeypatch.setattr(
+        pgo, 'get_host_info', lambda: (WINDOWS, 'x86_64', 'vcc')
+    )
+    monkeypatch.setattr(
+        pgo, 'get_c_compiler_used_to_build_python', lambda: 'vcc'
+    )
+
+    with pytest.raises(NimporterException, match='GCC'):
+        list(pgo.compile_extensions_with_pgo(extensions, 'python bench.py'))
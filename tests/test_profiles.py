@@ -0,0 +1,149 @@
+import sys
+import pytest
+from pathlib import Path
+from nimporter.lib import *
+
+PYPROJECT = '''
+[tool.nimporter]
+profile = "release"
+
+[tool.nimporter.extensions."pkg.hot"]
+profile = "fast"
+
+[tool.nimporter.profiles.fast]
+inherits = "danger"
+mm = "orc"
+lto = true
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.delenv('NIMPORTER_PROFILE', raising=False)
+    (tmp_path / 'pyproject.toml').write_text(PYPROJECT)
+    (tmp_path / 'pkg').mkdir()
+    return tmp_path
+
+
+def test_profile_is_selected_per_extension(project):
+    "Test extensions use their own profile or the project's profile"
+    assert get_build_profile(project / 'pkg' / 'hot.nim') == 'fast'
+    assert get_build_profile(project / 'pkg' / 'cold.nim') == 'release'
+    assert get_profile_args(project / 'pkg' / 'hot.nim') == [
+        '-d:danger', '--opt:speed', '--mm:orc', '--passC:-flto', '--passL:-flto'
+    ]
+
+
+def test_profile_can_be_overridden(project, monkeypatch):
+    "Test the environment overrides the project and arguments override both"
+    monkeypatch.setenv('NIMPORTER_PROFILE', 'size')
+    assert get_build_profile(project / 'pkg' / 'hot.nim') == 'size'
+    assert get_build_profile(project / 'pkg' / 'hot.nim', 'debug') == 'debug'
+
+    with pytest.raises(NimporterException):
+        get_profile_args(project / 'pkg' / 'hot.nim', 'missing')
+
+
+def test_default_profile_is_debug(tmp_path, monkeypatch):
+    "Test extensions outside of a configured project keep unoptimized builds"
+    monkeypatch.delenv('NIMPORTER_PROFILE', raising=False)
+    (tmp_path / 'pyproject.toml').write_text('[tool.other]\n')
+    assert get_profile_args(tmp_path / 'mod.nim') == []
+
+
+def test_cpu_variants_are_ordered_best_first(tmp_path, monkeypatch):
+    "Test CPU variants are opt-in, validated and tried most specialized first"
+    # Not `nimporter.lib` since other tests remove `nimporter` from
+    # sys.modules, leaving the submodule unreachable as an attribute
+    lib = sys.modules['nimporter.lib']
+    monkeypatch.setattr(
+        lib, 'get_host_info', lambda: ('linux', 'x86_64', 'gcc')
+    )
+    monkeypatch.delenv('NIMPORTER_CPU_VARIANTS', raising=False)
+    (tmp_path / 'pyproject.toml').write_text('[tool.other]\n')
+    assert get_cpu_variants(tmp_path / 'mod.nim') == []
+
+    monkeypatch.setenv('NIMPORTER_CPU_VARIANTS', 'x86-64-v2, native,x86-64-v3')
+    assert get_cpu_variants(tmp_path / 'mod.nim') == [
+        'native', 'x86-64-v3', 'x86-64-v2'
+    ]
+
+    monkeypatch.setenv('NIMPORTER_CPU_VARIANTS', 'pentium')
+
+    with pytest.raises(NimporterException):
+        get_cpu_variants(tmp_path / 'mod.nim')
+
+
+def test_extensions_are_named_by_whole_components(project):
+    "Test extension names match whole trailing components, most specific first"
+    with open(project / 'pyproject.toml', 'a') as config:
+        config.write(
+            '[tool.nimporter.extensions.hot]\nprofile = "size"\n'
+            '[tool.nimporter.extensions.ot]\nprofile = "debug"\n'
+        )
+
+    assert get_build_profile(project / 'pkg' / 'hot.nim') == 'fast'
+    assert get_build_profile(project / 'src' / 'pkg' / 'hot.nim') == 'fast'
+    assert get_build_profile(project / 'other' / 'hot.nim') == 'size'
+    assert get_build_profile(project / 'pkg' / 'not_hot.nim') == 'release'
+
+
+def test_imports_keep_extensions_compiled_with_a_profile(project):
+    "Test extensions built with an explicit profile are not rebuilt on import"
+    from nimporter.nimporter import (
+        get_build_args, should_compile, write_dependencies, write_hash
+    )
+    (project / 'pkg' / 'hot.nim').write_text('import nimpy')
+    ext = ExtLib(project / 'pkg' / 'hot.nim', project, False)
+    ext.pycache.mkdir()
+    ext.build_artifact.write_bytes(b'\x7fELF')
+    write_hash(ext, get_extension_hash(ext.relative_path))
+
+    write_dependencies(ext, [], get_build_args(ext, 'size'), profile='size')
+    assert not should_compile(ext)
+    assert should_compile(ext, 'debug')
+
+    write_dependencies(ext, [], get_build_args(ext, 'size'))
+    assert should_compile(ext)
+
+
+def test_cpu_variants_of_a_library_are_built_apart(tmp_path, monkeypatch):
+    "Test concurrent builds of a library's CPU variants keep their artifacts"
+    import time
+    nimporter = sys.modules['nimporter.nimporter']
+    lib = sys.modules['nimporter.lib']
+    monkeypatch.setattr(
+        lib, 'get_host_info', lambda: ('linux', 'x86_64', 'gcc')
+    )
+    monkeypatch.setattr(nimporter, 'ensure_nimpy', lambda: '')
+    monkeypatch.setenv('NIMPORTER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('NIMPORTER_CPU_VARIANTS', 'x86-64-v2,x86-64-v3')
+    monkeypatch.delenv('NIMPORTER_PROFILE', raising=False)
+    library = tmp_path / 'fast'
+    library.mkdir()
+    (library / 'fast.nim').write_text('import nimpy')
+    (library / 'fast.nimble').write_text('requires "nimpy"')
+    (library / 'fast.nim.cfg').write_text('')
+
+    def run_process(args, show_output=False, cwd=None):
+        # Nimble writes the artifact to the output folder (or the library)
+        out_dir = next(
+            (Path(arg.split(':', 1)[1]) for arg in args
+            if arg.startswith('--outdir:')),
+            cwd
+        )
+        march = [arg for arg in args if '-march' in arg]
+        (out_dir / 'fast.so').write_text(repr(march))
+        time.sleep(0.1)
+        return 0, '', ''
+
+    monkeypatch.setattr(nimporter, 'run_process', run_process)
+    extensions = nimporter.with_cpu_variants(
+        [ExtLib(library / 'fast.nim', tmp_path, True)]
+    )
+    assert len(extensions) == 3
+    list(nimporter.compile_extensions_concurrently(extensions, jobs=3))
+
+    for ext in extensions:
+        march = [arg for arg in ext.cpu_args if '-march' in arg]
+        assert ext.build_artifact.read_text() == repr(march)
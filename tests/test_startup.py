@@ -0,0 +1,63 @@
+import sys
+import subprocess
+from pathlib import Path
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+
+# Modules that must only be imported once they are actually needed
+DEFERRED_MODULES = {
+    'icecream',
+    'colorama',
+    'executing',
+    'asttokens',
+    'pygments',
+    'cpuinfo',
+    'setuptools',
+    'distutils',
+    'cookiecutter',
+    'concurrent.futures',
+    'nimporter.nexporter',
+    'nimporter.cli',
+    'nimporter.pgo',
+}
+
+
+def import_times(code):
+    "Returns the cumulative import time in microseconds of every module."
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=REPOSITORY,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def test_import_defers_heavy_dependencies():
+    "Test importing Nimporter only loads what is needed by the import hooks"
+    times = import_times('import nimporter')
+    assert not DEFERRED_MODULES & set(times)
+
+    # Generous bound to catch regressions, startup takes ~20ms on a laptop
+    assert times['nimporter'] < 250_000
+
+
+def test_packaging_is_imported_on_first_use():
+    "Test `get_nim_extensions` is still available from the top level module"
+    import_times(
+        'import sys, nimporter\n'
+        "assert 'nimporter.nexporter' not in sys.modules\n"
+        'assert callable(nimporter.get_nim_extensions)\n'
+        "assert 'nimporter.nexporter' in sys.modules\n"
+    )
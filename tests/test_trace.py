@@ -0,0 +1,32 @@
+from nimporter.trace import *
+
+
+def test_hooks_receive_spans():
+    "Test hooks are called with each finished span and its details"
+    spans = []
+    add_hook(spans.append)
+
+    try:
+        with span('outer', fullname='mod') as details:
+            with span('inner'):
+                pass
+            details['found'] = True
+    finally:
+        remove_hook(spans.append)
+
+    with span('unobserved'):
+        pass
+
+    assert [item.name for item in spans] == ['inner', 'outer']
+    assert spans[1].args == {'fullname': 'mod', 'found': True}
+    assert spans[1].duration >= spans[0].duration
+
+
+def test_chrome_trace_format():
+    "Test spans are converted to complete events in microseconds"
+    event, = to_chrome_trace([Span('hash', 1.5, 0.25, 7, {'path': 1})])[
+        'traceEvents'
+    ]
+    assert event['ph'] == 'X'
+    assert (event['ts'], event['dur'], event['tid']) == (1500000, 250000, 7)
+    assert event['args'] == {'path': '1'}